@@ -1,9 +1,9 @@
-from . import files, imports
-from .main import *
-
 __version__ = '1.0.0'
 __author__ = 'slycedf'
 __email__ = 'svntythsnd@gmail.com'
 __license__ = 'MIT'
 __description__ = 'python with braces.'
-__url__ = 'https://github.com/svntythsnd/nestpy'
\ No newline at end of file
+__url__ = 'https://github.com/svntythsnd/nestpy'
+
+from . import files, imports
+from .main import *
\ No newline at end of file
@@ -0,0 +1,158 @@
+# Command line: python -m nestpython [paths...] [--jobs N] [--check] [--stdout] [-0] [--filter]
+#
+# Every .npy/.npx file named, matched by a glob or found under a directory is
+# transpiled next to itself, as files.ncompile_to would, in one warm process.
+# -0 also reads a NUL-separated list of paths from stdin, and - transpiles stdin to
+# stdout. --filter stays up as a pipeline stage instead: it reads NUL-terminated
+# nestPython sources from stdin and answers each with its NUL-terminated Python.
+
+import argparse as _argparse
+import glob as _glob
+import os as _os
+import os.path as _path
+import sys as _sys
+
+from . import __version__, files as _files, main as _m
+
+_extensions = ('.npy', '.npx')
+
+def _records(stream):
+  # NUL-terminated records from a binary stream, each as soon as it is complete
+  parts = []
+  while chunk := stream.read1(1 << 16):
+    *records, last = chunk.split(b'\0')
+    if records:
+      records[0] = b''.join(parts + [records[0]])
+      parts = []
+      yield from records
+    parts.append(last)
+  if any(parts):
+    yield b''.join(parts)
+
+def _expand(paths):
+  # the source files named by paths, in order and without repeats
+  seen = set()
+  for path in paths:
+    if _path.isdir(path):
+      matches = sorted(_path.join(dirpath, file) for dirpath, dirnames, filenames in _os.walk(path)
+                       for file in filenames if file.endswith(_extensions))
+    elif _glob.has_magic(path):
+      matches = sorted(match for match in _glob.glob(path, recursive=True) if match.endswith(_extensions))
+    else:
+      matches = [path]
+    for match in matches:
+      if match not in seen:
+        seen.add(match)
+        yield match
+
+def _target(source):
+  return f'{_path.splitext(source)[0]}.py{"x" if source.endswith(".npx") else ""}'
+
+def _results(sources, indent_amount, jobs):
+  # (source, output or the exception raised) for each source, in order
+  if jobs == 1:
+    for source in sources:
+      try:
+        yield source, _files.ncompile(source, indent_amount=indent_amount)
+      except Exception as e:
+        yield source, e
+    return
+  from concurrent.futures import ProcessPoolExecutor
+  with ProcessPoolExecutor(jobs) as pool:
+    futures = [(source, pool.submit(_files.ncompile, source, indent_amount=indent_amount)) for source in sources]
+    for source, future in futures:
+      try:
+        yield source, future.result()
+      except Exception as e:
+        yield source, e
+
+def _read(file):
+  try:
+    with open(file, 'r', encoding='utf-8', newline='') as f:
+      return f.read()
+  except (OSError, UnicodeDecodeError):
+    return None
+
+def build(sources, *, indent_amount=1, jobs=1, check=False, stdout=False, quiet=False):
+  # Transpiles sources; returns how many failed, or with check, how many are stale.
+  # Outputs that are already up to date are left untouched, and unless the outputs go
+  # to stdout, a source that would be its own output is refused.
+  failed = 0
+  refused = [] if stdout else [source for source in sources if _path.abspath(_target(source)) == _path.abspath(source)]
+  for source in refused:
+    failed += 1
+    print(f'> refusing {source}: it would be overwritten by its own output', file=_sys.stderr)
+  sources = [source for source in sources if source not in refused]
+  for source, output in _results(sources, indent_amount, jobs):
+    if isinstance(output, Exception):
+      failed += 1
+      print(f'> failed {source}: {type(output).__name__}: {output}', file=_sys.stderr)
+      continue
+    if stdout:
+      _sys.stdout.write(output)
+      continue
+    target = _target(source)
+    if _read(target) == output:
+      continue
+    if check:
+      failed += 1
+      print(f'> stale {target}', file=_sys.stderr)
+      continue
+    if not quiet:
+      print(f'> compiled {source}', file=_sys.stderr)
+    with open(target, 'w', encoding='utf-8', newline='') as f:
+      f.write(output)
+  return failed
+
+def pipe(stdin, stdout, *, indent_amount=1, cythonic=False):
+  # Answers each NUL-terminated source on stdin with its transpiled output, flushed
+  # at once. A source that fails to transpile is answered with an empty record and
+  # reported on stderr. Returns how many failed.
+  failed = 0
+  for record in _records(stdin):
+    try:
+      output = _m.ncompile_bytes(record, indent_amount=indent_amount, cythonic=cythonic).encode('utf-8')
+    except Exception as e:
+      failed += 1
+      output = b''
+      print(f'> failed: {type(e).__name__}: {e}', file=_sys.stderr, flush=True)
+    stdout.write(output + b'\0')
+    stdout.flush()
+  return failed
+
+def main(argv=None):
+  parser = _argparse.ArgumentParser(prog='python -m nestpython', description='transpile nestPython to python')
+  parser.add_argument('paths', nargs='*', help='files, directories or globs to transpile; - reads stdin')
+  parser.add_argument('-0', '--null', action='store_true', help='also read NUL-separated paths from stdin')
+  parser.add_argument('-j', '--jobs', type=int, default=1, help='worker processes; 0 uses one per CPU core')
+  parser.add_argument('--check', action='store_true', help='write nothing, and fail if any output is stale')
+  parser.add_argument('--stdout', action='store_true', help='write the outputs to stdout instead of files')
+  parser.add_argument('--filter', action='store_true',
+                      help='transpile NUL-terminated sources from stdin to NUL-terminated outputs until EOF')
+  parser.add_argument('--cython', action='store_true', help='read stdin as nestCython')
+  parser.add_argument('--indent', type=int, default=1, help='indentation increment of the output')
+  parser.add_argument('-q', '--quiet', action='store_true', help='do not report the files written')
+  parser.add_argument('--version', action='version', version=f'nestpython {__version__}')
+  args = parser.parse_args(argv)
+
+  if args.filter:
+    if args.paths or args.null:
+      parser.error('--filter reads sources from stdin only')
+    return 1 if pipe(_sys.stdin.buffer, _sys.stdout.buffer, indent_amount=args.indent, cythonic=args.cython) else 0
+  if args.paths == ['-']:
+    _m.ncompile_stream(_sys.stdin, _sys.stdout, indent_amount=args.indent, cythonic=args.cython, filename='<stdin>')
+    return 0
+  if '-' in args.paths:
+    parser.error('- cannot be combined with other paths')
+  paths = list(args.paths)
+  if args.null:
+    paths += [_os.fsdecode(record) for record in _records(_sys.stdin.buffer) if record]
+  if not paths:
+    parser.error('no paths given')
+  sources = list(_expand(paths))
+  failed = build(sources, indent_amount=args.indent, jobs=args.jobs or None, check=args.check,
+                 stdout=args.stdout, quiet=args.quiet)
+  return 1 if failed else 0
+
+if __name__ == '__main__':
+  _sys.exit(main())
@@ -0,0 +1,225 @@
+# Transpiler benchmarks: python -m nestpython.bench [--save out.json] [--compare baseline.json]
+#
+# Synthetic .npy/.npx corpora of increasing size are transpiled with main.ncompile,
+# built with files.nbuild and imported through nestpython.imports in fresh
+# interpreters. Throughput is reported in KB/s and tokens/s; results can be saved as
+# JSON and compared against an earlier run, failing when throughput drops too far.
+
+import argparse as _argparse
+import contextlib as _contextlib
+import io as _io
+import json as _json
+import os as _os
+import platform as _platform
+import subprocess as _subprocess
+import sys as _sys
+import tempfile as _tempfile
+from time import perf_counter as _perf_counter
+
+from . import __version__, files as _files, main as _m
+
+# ----------------- #
+#      CORPORA      #
+# ----------------- #
+
+def nesting(size):
+  # deeply nested blocks, closed and reopened over and over
+  parts = []
+  length = 0
+  n = 0
+  while length < size:
+    n += 1
+    depth = n % 24 + 1
+    block = (f':= nest{n}(x) {{ ' + ''.join(f'if x > {d} {{ x ++; ' for d in range(depth)) + '}' * depth
+             + ' => x }\n')
+    parts.append(block)
+    length += len(block)
+  return ''.join(parts)
+
+_multiline = 'multi { line } ; string // not a comment\n'
+
+def strings(size):
+  # long plain, multiline and f-strings, full of characters the tokenizer looks at
+  parts = []
+  length = 0
+  n = 0
+  while length < size:
+    n += 1
+    block = (f's{n} = "{"lorem ipsum dolor sit amet; {braces} && || -> " * 8}";\n'
+             f'f{n} = f\'{{s{n}}} {{len(s{n}) + {n}}} {{{{literal}}}} {"consectetur adipiscing " * 4}\';\n'
+             f'd{n} = """{_multiline * 4}end""";\n')
+    parts.append(block)
+    length += len(block)
+  return ''.join(parts)
+
+def macros(size):
+  # macro definitions in nested scopes and many uses of them
+  parts = ['# inc #!counter ++;!#\n# show #!log.append((counter, $name));!#\n# name #!"bench"!#\ncounter = 0; log = [];\n']
+  length = len(parts[0])
+  n = 0
+  while length < size:
+    n += 1
+    block = (f':= f{n}() {{ global counter; # local #!counter += {n};!#\n  $inc $local $show #? local ?# }}\nf{n}();\n'
+             + '$inc $show\n' * 8)
+    parts.append(block)
+    length += len(block)
+  return ''.join(parts)
+
+def cython(size):
+  # nestCython declarations and functions
+  parts = []
+  length = 0
+  n = 0
+  while length < size:
+    n += 1
+    block = (f'$= int a{n} = {n};\n'
+             f'~$= int g{n}(int x, int y) >: int {{ $= int z = x ~/ y; => z && a{n} }}\n'
+             f'cdef = {n}; cpdef = cdef || {n};\n')
+    parts.append(block)
+    length += len(block)
+  return ''.join(parts)
+
+corpora = {
+  'nesting': (nesting, False),
+  'strings': (strings, False),
+  'macros': (macros, False),
+  'cython': (cython, True),
+}
+
+# ----------------- #
+#      RUNNERS      #
+# ----------------- #
+
+def _best(function, repeat):
+  times = []
+  for _ in range(repeat):
+    start = _perf_counter()
+    function()
+    times.append(_perf_counter() - start)
+  return min(times)
+
+def _result(seconds, size, tokens):
+  return {'seconds': seconds, 'kb_per_s': size / 1024 / seconds, 'tokens_per_s': tokens / seconds}
+
+def bench_ncompile(sizes, repeat):
+  results = {}
+  for name, (generate, cythonic) in corpora.items():
+    for size in sizes:
+      code = generate(size)
+      tokens = len(_m.grammar(cythonic).tokenize(code))
+      seconds = _best(lambda: _m.ncompile(code, cythonic=cythonic), repeat)
+      results[f'ncompile/{name}/{size // 1024}k'] = _result(seconds, len(code), tokens)
+  return results
+
+def bench_nbuild(sizes, repeat, modules=32):
+  results = {}
+  for size in sizes:
+    with _tempfile.TemporaryDirectory() as root:
+      source = f'{root}/src'
+      _os.mkdir(source)
+      total = 0
+      tokens = 0
+      for n, (name, (generate, cythonic)) in enumerate(list(corpora.items()) * (modules // len(corpora))):
+        code = generate(size // modules)
+        total += len(code)
+        tokens += len(_m.grammar(cythonic).tokenize(code))
+        with open(f'{source}/{name}{n}.np{"x" if cythonic else "y"}', 'w', encoding='utf-8') as f:
+          f.write(code)
+      def build():
+        with _contextlib.redirect_stdout(_io.StringIO()):
+          _files.nbuild(source, f'{root}/build', erase_dir=True)
+      results[f'nbuild/{modules}files/{size // 1024}k'] = _result(_best(build, repeat), total, tokens)
+  return results
+
+_importScript = '''
+import sys
+from time import perf_counter
+start = perf_counter()
+import nestpython.imports
+for n in range({modules}):
+  __import__(f'benchmod{{n}}')
+print(perf_counter() - start)
+'''
+
+def bench_imports(sizes, repeat, modules=16):
+  # each import runs in a fresh interpreter; first with the bytecode cache disabled,
+  # then again with it warm
+  results = {}
+  package = _os.path.dirname(_os.path.dirname(_os.path.abspath(__file__)))
+  for size in sizes:
+    with _tempfile.TemporaryDirectory() as root:
+      total = 0
+      tokens = 0
+      for n in range(modules):
+        code = (nesting, strings, macros)[n % 3](size // modules)
+        total += len(code)
+        tokens += len(_m.grammar(False).tokenize(code))
+        with open(f'{root}/benchmod{n}.npy', 'w', encoding='utf-8') as f:
+          f.write(code)
+      script = _importScript.format(modules=modules)
+      def run(**env):
+        environ = dict(_os.environ, PYTHONPATH=_os.pathsep.join([root, package]), **env)
+        environ.pop('PYTHONDONTWRITEBYTECODE', None)
+        times = [float(_subprocess.run([_sys.executable, '-c', script], env=environ, cwd=root, check=True,
+                                       capture_output=True, text=True).stdout) for _ in range(repeat)]
+        return min(times)
+      results[f'import/cold/{size // 1024}k'] = _result(run(NESTPYTHON_NOCACHE='1'), total, tokens)
+      run()
+      results[f'import/cached/{size // 1024}k'] = _result(run(), total, tokens)
+  return results
+
+benches = {
+  'ncompile': bench_ncompile,
+  'nbuild': bench_nbuild,
+  'imports': bench_imports,
+}
+
+def run(sizes=(16 * 1024, 64 * 1024, 256 * 1024), repeat=3, only=None):
+  results = {}
+  for name, bench in benches.items():
+    if only is None or name in only:
+      for key, result in bench(sizes, repeat).items():
+        print(f'> {key:32} {result["kb_per_s"]:10.1f} KB/s {result["tokens_per_s"]:12.0f} tokens/s')
+        results[key] = result
+  return {
+    'version': __version__,
+    'python': _platform.python_version(),
+    'results': results,
+  }
+
+def compare(results, baseline, threshold=0.2):
+  # returns the keys whose throughput dropped by more than threshold against baseline
+  regressions = []
+  for key, result in results['results'].items():
+    if key not in baseline['results']:
+      continue
+    ratio = result['kb_per_s'] / baseline['results'][key]['kb_per_s']
+    print(f'> {key:32} {ratio:6.2f}x baseline{"  REGRESSION" if ratio < 1 - threshold else ""}')
+    if ratio < 1 - threshold:
+      regressions.append(key)
+  return regressions
+
+def main(argv=None):
+  parser = _argparse.ArgumentParser(prog='python -m nestpython.bench', description='benchmark the nestPython transpiler')
+  parser.add_argument('--sizes', type=int, nargs='+', default=[16, 64, 256], metavar='KB',
+                      help='corpus sizes in kilobytes')
+  parser.add_argument('--repeat', type=int, default=3, help='runs per measurement; the fastest counts')
+  parser.add_argument('--only', nargs='+', choices=list(benches), help='run only these benchmarks')
+  parser.add_argument('--save', metavar='FILE', help='write the results as JSON')
+  parser.add_argument('--compare', metavar='FILE', help='compare against results saved earlier')
+  parser.add_argument('--threshold', type=float, default=0.2,
+                      help='fail when throughput drops by more than this fraction of the baseline')
+  args = parser.parse_args(argv)
+  results = run([size * 1024 for size in args.sizes], args.repeat, args.only)
+  if args.save:
+    with open(args.save, 'w', encoding='utf-8') as f:
+      _json.dump(results, f, indent=1)
+  if args.compare:
+    with open(args.compare, 'r', encoding='utf-8') as f:
+      baseline = _json.load(f)
+    if compare(results, baseline, args.threshold):
+      return 1
+  return 0
+
+if __name__ == '__main__':
+  _sys.exit(main())
@@ -0,0 +1,94 @@
+# Importer for bundles written by nestpython.files.nbundle.
+#
+# A bundle is an uncompressed zip of precompiled modules (.pyc) and other files,
+# with a marshalled index of them whose position is kept in the zip comment. The
+# importer reads the whole bundle with one open, finds modules in the index and
+# unmarshals their code straight from memory: nothing is looked up on disk and no
+# transpiler is imported. This module only uses the standard library, and nbundle
+# copies it into every bundle as nestpython_bundle, so a deployed application only
+# needs
+#
+#     sys.path.insert(0, 'app.nbz')
+#     import nestpython_bundle
+#
+# where nestpython is installed, install('app.nbz') does the same.
+
+import marshal as _marshal
+import os.path as _path
+import sys as _sys
+from importlib.machinery import ModuleSpec as _ModuleSpec
+
+_commentPrefix = b'nestpython-bundle:'
+_endRecord = b'PK\x05\x06'
+
+class BundleImporter:
+    # A meta path finder and loader for the modules of one bundle. index maps module
+    # names to (offset, size, is_package, member) and member names of other files to
+    # (offset, size).
+
+    def __init__(self, path):
+        self.path = _path.abspath(path)
+        with open(self.path, 'rb') as f:
+            self.data = f.read()
+        end = self.data.rfind(_endRecord, max(0, len(self.data) - (1 << 16) - 22))
+        comment = self.data[end + 22:]
+        if end < 0 or not comment.startswith(_commentPrefix):
+            raise ImportError(f'{path} is not a nestpython bundle', path=path)
+        offset, size = map(int, comment[len(_commentPrefix):].split(b':'))
+        tag, self.modules, self.files = _marshal.loads(self.data[offset:offset + size])
+        if tag != _sys.implementation.cache_tag:
+            raise ImportError(f'{path} was built for {tag}, not {_sys.implementation.cache_tag}', path=path)
+
+    def find_spec(self, fullname, path, target=None):
+        entry = self.modules.get(fullname)
+        if entry is None:
+            return None
+        offset, size, is_package, member = entry
+        origin = _path.join(self.path, member)
+        spec = _ModuleSpec(fullname, self, origin=origin, is_package=is_package)
+        if is_package:
+            spec.submodule_search_locations = [_path.dirname(origin)]
+        spec.has_location = True
+        return spec
+
+    def invalidate_caches(self):
+        pass
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        exec(self.get_code(module.__spec__.name), module.__dict__)
+
+    def get_code(self, fullname):
+        offset, size, is_package, member = self.modules[fullname]
+
+        # skip the 16 byte .pyc header
+
+        return _marshal.loads(memoryview(self.data)[offset + 16:offset + size])
+
+    def is_package(self, fullname):
+        return self.modules[fullname][2]
+
+    def get_source(self, fullname):
+        return None
+
+    def get_data(self, path):
+        # the bytes of a file stored in the bundle, by its path under the bundle
+        member = _path.relpath(path, self.path).replace(_path.sep, '/')
+        if member not in self.files:
+            raise FileNotFoundError(path)
+        offset, size = self.files[member]
+        return self.data[offset:offset + size]
+
+def install(path):
+    # puts an importer for the bundle at path ahead of every other finder and returns it
+    importer = BundleImporter(path)
+    _sys.meta_path.insert(0, importer)
+    return importer
+
+if __name__ == 'nestpython_bundle':
+
+    # loaded from inside a bundle: install the bundle this module came from
+
+    importer = install(_path.dirname(__file__))
@@ -1,13 +1,30 @@
 from os import mkdir as _mkdir
 import os.path as _path
 from os import walk as _walk
-from os import scandir as _scandir
-from os import chdir as _chdir
-from os import getcwd as _getcwd
 from shutil import copyfile as _copyfile
 from shutil import rmtree as _rmtree
+from os import makedirs as _makedirs
+from hashlib import sha256 as _sha256
+from contextlib import contextmanager as _contextmanager
+import mmap as _mmap
+import json as _json
+import marshal as _marshal
+import struct as _struct
+from collections import namedtuple as _namedtuple
+from functools import partial as _partial
+import sys as _sys
+from os import close as _close
+from os import fsdecode as _fsdecode
+from os import fsencode as _fsencode
+from os import fstat as _fstat
+from os import read as _read
+from os import remove as _remove
+from os import stat as _stat
+from select import select as _select
+from time import perf_counter as _perf_counter
+from time import sleep as _sleep
 
-from . import main as _m
+from . import main as _m, __version__
 
 _slashConverter = str.maketrans('\\','/')
 def _getAllFilePaths(dirPath):
@@ -17,20 +34,6 @@ def _getAllFilePaths(dirPath):
         ) in _walk(dirPath) for f in filenames
     ]
 
-def _getFilesDirs(dirPath):
-    oldDir=_getcwd()
-    _chdir(dirPath)
-    a = []
-    b = []
-    for f in _scandir():
-        g = f.path.translate(_slashConverter).removeprefix('./')
-        if f.is_dir():
-            b.append(g)
-        else:
-            a.append(g)
-    _chdir(oldDir)
-    return a, b
-
 def _filterByFileExt(files, *fileExts:str):
     passed = []
     failed = []
@@ -41,15 +44,25 @@ def _filterByFileExt(files, *fileExts:str):
         failed.append(file)
     return passed, failed
 
+@_contextmanager
+def _mapFile(file):
+  # the file's bytes, memory-mapped rather than read in; mmap can't map empty files
+  with open(file, 'rb') as f:
+    if not _fstat(f.fileno()).st_size:
+      yield b''
+      return
+    with _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ) as data:
+      yield data
+
 def ncompile_to(file:str, new_file:str=None, *, indent_amount:int=1, replace_previous:bool=False, cythonic:bool=None, tokenlog:bool=False):
   cythonic = _path.splitext(file)[~0] == '.npx' if cythonic is None else cythonic
   new_file = f'{_path.splitext(file)[0]}.py{"x" if cythonic else ""}' if new_file is None else new_file
   def compile(file):
     print(f'> compiling {file}')
     with (
-      open(file, 'r', encoding='utf-8') as f,
+      _mapFile(file) as data,
       open(new_file, 'w', encoding='utf-8') as fn):
-        fn.write(_m.ncompile(f.read(), indent_amount=indent_amount, cythonic=cythonic, tokenlog=tokenlog, filename=file))
+        _m.ncompile_bytes(data, fn, indent_amount=indent_amount, cythonic=cythonic, tokenlog=tokenlog, filename=file)
   if not _path.isfile(new_file) or replace_previous:
     compile(file)
   else:
@@ -59,52 +72,485 @@ def ncompile_to(file:str, new_file:str=None, *, indent_amount:int=1, replace_pre
       compile(file)
 
 
-def nbuild(dir:str, new_dir:str, *, indent_amount:int=1, erase_dir:bool=None,
-           replace_previous:bool=False, transfer_other_files:bool=True):
- subpath = ''
- def subbuild():
-    nonlocal dir
-    nonlocal subpath
-    nonlocal new_dir
-    nonlocal indent_amount
-    nonlocal erase_dir
-    nonlocal replace_previous
-    nonlocal transfer_other_files
-    if _path.isdir(f'{new_dir}/{subpath}'):
-      def remove():
-        _rmtree(f'{new_dir}/{subpath}')
-        _mkdir(f'{new_dir}/{subpath}')
-      if erase_dir:
-          remove()
-      elif erase_dir is None:
-          i = input(
-            f'Directory \'{new_dir}/{subpath}\' already exists. Would you like to erase it? [y/(n)]: ')
-          if i.lower() == 'y':
-            remove()
+def _buildFile(file, new_file, indent_amount, cythonic, stats=False):
+  # returns the source's hash, along with its CompileStats if stats is set
+  fileStats = _m.CompileStats() if stats else None
+  with _mapFile(file) as data:
+    compiled = _m.ncompile_bytes(data, indent_amount=indent_amount, cythonic=cythonic, filename=file,
+                                 stats=fileStats)
+    digest = _sha256(data).hexdigest()
+  with open(new_file, 'w', encoding='utf-8') as fn:
+    fn.write(compiled)
+  return (digest, fileStats) if stats else digest
+
+def _hashFile(file):
+  with open(file, 'rb') as f:
+    return _sha256(f.read()).hexdigest()
+
+_manifestName = '.nestpython-manifest.json'
 
+def _loadManifest(new_dir):
+  try:
+    with open(f'{new_dir}/{_manifestName}', 'r', encoding='utf-8') as f:
+      manifest = _json.load(f)
+  except (OSError, ValueError):
+    return {}
+  return manifest.get('files', {}) if manifest.get('version') == __version__ else {}
+
+def _saveManifest(new_dir, files):
+  with open(f'{new_dir}/{_manifestName}', 'w', encoding='utf-8') as f:
+    _json.dump({'version': __version__, 'files': files}, f, indent=1, sort_keys=True)
+
+def _ask(question):
+  return input(f'{question} [y/(n)]: ').lower() == 'y'
+
+def _plan(dir, new_dir, indent_amount, erase_dir, replace_previous, transfer_other_files, incremental, ask):
+  # Walks dir, preparing new_dir and deciding what becomes of every file. Returns the
+  # sources to transpile, the files to transfer, the sources skipped and the manifest
+  # entries kept. ask(question) settles what the arguments leave open; without it,
+  # existing directories and files are left as they are.
+  manifest = _loadManifest(new_dir) if incremental else {}
+  newManifest = {}
+  queued = []
+  transfers = []
+  skipped = []
+  new_root = _path.abspath(new_dir)
+  for dirpath, dirnames, filenames in _walk(dir):
+    dirnames[:] = sorted(d for d in dirnames if _path.abspath(_path.join(dirpath, d)) != new_root)
+    subpath = _path.relpath(dirpath, dir).translate(_slashConverter).removeprefix('.')
+    target = f'{new_dir}/{subpath}' if subpath else new_dir
+    if _path.isdir(target):
+      if erase_dir or (erase_dir is None and not incremental and ask is not None
+                       and ask(f'Directory \'{target}\' already exists. Would you like to erase it?')):
+        _rmtree(target)
+        _mkdir(target)
     else:
-      _mkdir(f'{new_dir}/{subpath}')
-    compilable, leaveBe = _filterByFileExt(_getFilesDirs(f'{dir}/{subpath}')[0], '.npy', '.npx')
+      _makedirs(target)
+    compilable, leaveBe = _filterByFileExt(sorted(filenames), '.npy', '.npx')
     for file in compilable:
-      ncompile_to(f'{dir}/{subpath}/{file}', f'{new_dir}/{subpath}/{(fsplit := _path.splitext(file.rsplit("/", 1)[-1]))[0]}.py{"x" if fsplit[~0] == ".npx" else ""}',
-               indent_amount=indent_amount, replace_previous=replace_previous)
+      source = f'{dirpath}/{file}'.translate(_slashConverter)
+      key = f'{subpath}/{file}' if subpath else file
+      stem, ext = _path.splitext(file)
+      cythonic = ext == '.npx'
+      new_file = f'{target}/{stem}.py{"x" if cythonic else ""}'
+      options = [indent_amount, cythonic]
+      if _path.isfile(new_file):
+        if incremental:
+          entry = manifest.get(key)
+          if entry is None or entry[1:] == options:
+            if _path.getmtime(new_file) >= _path.getmtime(source):
+              skipped.append(source)
+              if entry is not None:
+                newManifest[key] = entry
+              continue
+            if entry is not None and entry[0] == _hashFile(source):
+              skipped.append(source)
+              newManifest[key] = entry
+              continue
+        elif not replace_previous and (ask is None or not ask(
+            f'File \'{new_file}\' already exists. Would you like to overwrite it?')):
+          skipped.append(source)
+          continue
+      queued.append((key, source, new_file, options))
     if transfer_other_files:
       for file in leaveBe:
-        print(f'> transferring {dir}/{subpath}/{file}')
-        _copyfile(f'{dir}/{subpath}/{file}', f'{new_dir}/{subpath}/{file.rsplit("/", 1)[-1].lstrip("/")}')
-    for subdir in _getFilesDirs(f'{dir}/{subpath}')[~0]:
-        subpath += subdir
-        subbuild()
+        new_file = f'{target}/{file}'
+        if incremental and _path.isfile(new_file) and _path.getmtime(new_file) >= _path.getmtime(f'{dirpath}/{file}'):
+          continue
+        transfers.append((f'{dirpath}/{file}', new_file))
+  return queued, transfers, skipped, newManifest
+
+def nbuild(dir:str, new_dir:str, *, indent_amount:int=1, erase_dir:bool=None,
+           replace_previous:bool=False, transfer_other_files:bool=True,
+           jobs:int=1, incremental:bool=False, stats:bool=False):
+ # jobs > 1 transpiles on that many worker processes, jobs=None on one per core.
+ # incremental skips sources whose output is newer, or whose hash matches the
+ # manifest kept in new_dir; outputs it does rebuild are replaced without asking.
+ # stats prints where transpiling each file spent its time, slowest first, and
+ # returns the CompileStats by source path.
+ queued, transfers, skipped, newManifest = _plan(dir, new_dir, indent_amount, erase_dir, replace_previous,
+                                                 transfer_other_files, incremental, _ask)
+ for source, new_file in transfers:
+    print(f'> transferring {source}')
+    _copyfile(source, new_file)
+
+ failed = 0
+ reports = {}
+ def done(key, source, options, result):
+    nonlocal failed
+    try:
+      digest = result()
+    except Exception as e:
+      failed += 1
+      print(f'> failed {source}: {type(e).__name__}: {e}')
+      return
+    if stats:
+      digest, reports[source] = digest
+    newManifest[key] = [digest, *options]
+
+ if jobs == 1:
+    for key, source, new_file, options in queued:
+      print(f'> compiling {source}')
+      done(key, source, options, lambda: _buildFile(source, new_file, *options, stats))
+ else:
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(jobs) as pool:
+      futures = []
+      for key, source, new_file, options in queued:
+        print(f'> compiling {source}')
+        futures.append((key, source, options, pool.submit(_buildFile, source, new_file, *options, stats)))
+      for key, source, options, future in futures:
+        done(key, source, options, future.result)
+
+ if incremental:
+    _saveManifest(new_dir, newManifest)
+ print(f'> compiled! ({len(queued) - failed} compiled, {len(skipped)} skipped, {failed} failed)\n')
+ if stats:
+    _printReports(reports)
+    return reports
+
+def _printReports(reports):
+  total = _m.CompileStats()
+  for source, fileStats in sorted(reports.items(), key=lambda item: -item[1].total):
+    total.merge(fileStats)
+    phases = ', '.join(f'{phase} {fileStats.times[phase] / (fileStats.total or 1):.0%}' for phase in fileStats.phases)
+    print(f'> {fileStats.total * 1000:8.1f}ms {source} ({phases}; {sum(fileStats.tokens.values())} tokens,'
+          f' {fileStats.pushbacks} pushbacks, {fileStats.expansions} macro expansions)')
+  print(f'> total over {total.runs} files: {total.report()}\n')
+
+def _bundleModule(file, filename, cythonic, indent_amount=1):
+  # the .pyc bytes of a source: unchecked hash-based, so zipimport takes them too
+  from importlib.util import MAGIC_NUMBER, source_hash
+  with open(file, 'rb') as f:
+    data = f.read()
+  if file.endswith('.py'):
+    code = compile(data, filename, 'exec', dont_inherit=True)
+  else:
+    code = _m.ncompile_code(data.decode('utf-8'), filename, indent_amount=indent_amount, cythonic=cythonic)
+  return MAGIC_NUMBER + (1).to_bytes(4, 'little') + source_hash(data) + _marshal.dumps(code)
+
+def nbundle(dir:str, bundle:str, *, indent_amount:int=1, transfer_other_files:bool=True, jobs:int=1, main:str=None):
+  # Precompiles every .npy, .npx and .py module under dir into one bundle file for
+  # nestpython.bundle to import from, with the other files alongside if
+  # transfer_other_files. Bytecode is for the running interpreter only. With main,
+  # the bundle also runs as python bundle, executing that module as __main__.
+  import zipfile
+  from . import bundle as bundleModule
+  modules = {}
+  others = []
+  for dirpath, dirnames, filenames in _walk(dir):
+    dirnames[:] = sorted(d for d in dirnames if d != '__pycache__')
+    for file in sorted(filenames):
+      source = _path.join(dirpath, file)
+      stem, ext = _path.splitext(_path.relpath(source, dir).translate(_slashConverter))
+      if ext not in ('.npy', '.npx', '.py'):
+        if transfer_other_files:
+          others.append((source, f'{stem}{ext}'))
+        continue
+      parts = stem.split('/')
+      is_package = parts[-1] == '__init__'
+      name = '.'.join(parts[:-1] if is_package else parts)
+
+      # the import hook finds .npy and .npx files ahead of .py ones
+
+      if name and (name not in modules or modules[name][0].endswith('.py')):
+        modules[name] = (source, f'{stem}{ext}', ext == '.npx', is_package)
+
+  results = {}
+  failed = 0
+  if jobs == 1:
+    for name, (source, filename, cythonic, is_package) in modules.items():
+      print(f'> compiling {source}')
+      results[name] = _partial(_bundleModule, source, filename, cythonic, indent_amount)
+  else:
+    from concurrent.futures import ProcessPoolExecutor
+    pool = ProcessPoolExecutor(jobs)
+    for name, (source, filename, cythonic, is_package) in modules.items():
+      print(f'> compiling {source}')
+      results[name] = pool.submit(_bundleModule, source, filename, cythonic, indent_amount).result
+
+  index = {}
+  files = {}
+  try:
+    with zipfile.ZipFile(bundle, 'w', zipfile.ZIP_STORED) as zf:
+      def add(member, data):
+        zf.writestr(member, data)
+        info = zf.getinfo(member)
+        encoded = info.filename.encode('ascii' if info.filename.isascii() else 'utf-8')
+        return info.header_offset + 30 + len(encoded) + len(info.extra), len(data)
+      for name, result in results.items():
+        source, filename, cythonic, is_package = modules[name]
+        member = f'{_path.splitext(filename)[0]}.pyc'
+        try:
+          data = result()
+        except Exception as e:
+          failed += 1
+          print(f'> failed {source}: {type(e).__name__}: {e}')
+          continue
+        index[name] = (*add(member, data), is_package, member)
+      for source, member in others:
+        print(f'> transferring {source}')
+        with open(source, 'rb') as f:
+          files[member] = add(member, f.read())
+      zf.writestr('nestpython_bundle.pyc', _bundleModule(bundleModule.__file__, 'nestpython_bundle.py', False))
+      if main is not None:
+        zf.writestr('__main__.py', f'import nestpython_bundle, runpy\nrunpy.run_module({main!r}, run_name=\'__main__\', alter_sys=True)\n')
+      offset, size = add('__index__', _marshal.dumps((_sys.implementation.cache_tag, index, files)))
+      zf.comment = f'nestpython-bundle:{offset}:{size}'.encode('ascii')
+  finally:
+    if jobs != 1:
+      pool.shutdown()
+  print(f'> bundled! ({len(index)} modules, {len(files)} files, {failed} failed)\n')
 
- subbuild()
- print(f'> compiled!\n')
+def _statFiles(dirpath, filenames):
+  files = {}
+  for file in filenames:
+    source = f'{dirpath}/{file}'.translate(_slashConverter)
+    try:
+      st = _stat(source)
+    except OSError:
+      continue
+    files[source] = (st.st_mtime_ns, st.st_size)
+  return files
+
+def _snapshot(dir, new_root, recursive=True):
+  # the (mtime, size) of every file under dir (or only in it), by directory path and
+  # then by source path
+  files = {}
+  for dirpath, dirnames, filenames in _walk(dir):
+    dirnames[:] = [d for d in dirnames if _path.abspath(_path.join(dirpath, d)) != new_root] if recursive else []
+    files[dirpath] = _statFiles(dirpath, filenames)
+  return files
+
+def _rescan(files, changed, new_root):
+  # A copy of the snapshot files with the (dirpath, recursive) pairs in changed read
+  # again, and the directories whose entries may differ from files.
+  files = dict(files)
+  affected = set()
+  for dirpath, recursive in changed:
+    prefix = _path.join(dirpath, '')
+    for stale in [d for d in files if d == dirpath or recursive and d.startswith(prefix)]:
+      del files[stale]
+      affected.add(stale)
+    if _path.abspath(dirpath) != new_root:
+      rescanned = _snapshot(dirpath, new_root, recursive)
+      files.update(rescanned)
+      affected.update(rescanned)
+  return files, affected
+
+_inotifyEvent = _struct.Struct('iIII')
+
+class _InotifyWatcher:
+  # Watches every directory under dir (but new_root) through inotify. wait() blocks
+  # until something changes and returns the (dirpath, recursive) pairs to read again,
+  # or None when events were lost and everything has to be.
+
+  IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+  IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+  IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+  mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+  def __init__(self, libc, fd, new_root):
+    self.libc = libc
+    self.fd = fd
+    self.new_root = new_root
+    self.dirs = {}
+
+  @classmethod
+  def open(cls, dir, new_root):
+    # a watcher for dir, or None where inotify is unavailable
+    if not _sys.platform.startswith('linux'):
+      return None
+    try:
+      import ctypes
+      import ctypes.util
+      libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+      fd = libc.inotify_init1(0o2000000) # IN_CLOEXEC
+    except (OSError, AttributeError):
+      return None
+    if fd < 0:
+      return None
+    watcher = cls(libc, fd, new_root)
+    watcher.watch(dir)
+    return watcher
+
+  def watch(self, dir):
+    for dirpath, dirnames, filenames in _walk(dir):
+      dirnames[:] = [d for d in dirnames if _path.abspath(_path.join(dirpath, d)) != self.new_root]
+      if (wd := self.libc.inotify_add_watch(self.fd, _fsencode(dirpath), self.mask)) >= 0:
+        self.dirs[wd] = dirpath
+
+  def unwatch(self, dir):
+    prefix = _path.join(dir, '')
+    for wd, dirpath in list(self.dirs.items()):
+      if dirpath == dir or dirpath.startswith(prefix):
+        self.libc.inotify_rm_watch(self.fd, wd)
+        del self.dirs[wd]
+
+  def wait(self):
+    _select([self.fd], [], [])
+    _sleep(0.05) # let bursts of events (editors saving via temp files) settle
+    changed = set()
+    while _select([self.fd], [], [], 0)[0]:
+      data = _read(self.fd, 65536)
+      offset = 0
+      while offset < len(data):
+        wd, mask, cookie, length = _inotifyEvent.unpack_from(data, offset)
+        name = _fsdecode(data[offset + _inotifyEvent.size:offset + _inotifyEvent.size + length].rstrip(b'\0'))
+        offset += _inotifyEvent.size + length
+        if mask & self.IN_Q_OVERFLOW:
+          changed = None
+        if mask & self.IN_IGNORED:
+          self.dirs.pop(wd, None)
+        if changed is None or wd not in self.dirs:
+          continue
+        dirpath = self.dirs[wd]
+        if not mask & self.IN_ISDIR:
+          changed.add((dirpath, False))
+          continue
+        child = _path.join(dirpath, name)
+        if _path.abspath(child) == self.new_root:
+          continue
+        if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+          self.watch(child)
+        elif mask & self.IN_MOVED_FROM:
+          self.unwatch(child)
+        changed.add((child, True))
+    return changed
+
+  def close(self):
+    _close(self.fd)
+
+def nwatch(dir:str, new_dir:str, *, indent_amount:int=1, transfer_other_files:bool=True, interval:float=0.5):
+  # Builds dir incrementally, then keeps new_dir in sync until interrupted: changed or
+  # added sources are transpiled in this process, deleted ones are removed from new_dir.
+  # Where inotify is available, it blocks until a change is reported and only reads
+  # the directories it names again; elsewhere the tree is polled every interval seconds.
+  nbuild(dir, new_dir, indent_amount=indent_amount, erase_dir=False,
+         transfer_other_files=transfer_other_files, incremental=True)
+  new_root = _path.abspath(new_dir)
+  def target(source):
+    subpath = _path.relpath(source, dir).translate(_slashConverter)
+    stem, ext = _path.splitext(subpath)
+    if ext in ('.npy', '.npx'):
+      return f'{new_dir}/{stem}.py{"x" if ext == ".npx" else ""}'
+    return f'{new_dir}/{subpath}' if transfer_other_files else None
+  watcher = _InotifyWatcher.open(dir, new_root)
+  files = _snapshot(dir, new_root)
+  try:
+    while True:
+      if watcher is None:
+        _sleep(interval)
+        changed = None
+      else:
+        changed = watcher.wait()
+      if changed is None:
+        newFiles = _snapshot(dir, new_root)
+        affected = files.keys() | newFiles.keys()
+      else:
+        newFiles, affected = _rescan(files, changed, new_root)
+      removed = []
+      updated = []
+      for dirpath in affected:
+        old = files.get(dirpath, {})
+        new = newFiles.get(dirpath, {})
+        removed += old.keys() - new.keys()
+        updated += [source for source, st in new.items() if old.get(source) != st]
+      for source in sorted(removed):
+        new_file = target(source)
+        if new_file is not None and _path.isfile(new_file):
+          print(f'> removing {new_file}')
+          _remove(new_file)
+      for source in sorted(updated):
+        if (new_file := target(source)) is None:
+          continue
+        _makedirs(_path.dirname(new_file) or '.', exist_ok=True)
+        if source.endswith(('.npy', '.npx')):
+          print(f'> compiling {source}')
+          start = _perf_counter()
+          try:
+            _buildFile(source, new_file, indent_amount, source.endswith('.npx'))
+          except Exception as e:
+            print(f'> failed {source}: {type(e).__name__}: {e}')
+            continue
+          print(f'> compiled in {(_perf_counter() - start) * 1000:.1f}ms')
+        else:
+          print(f'> transferring {source}')
+          _copyfile(source, new_file)
+      files = newFiles
+  except KeyboardInterrupt:
+    print(f'> stopped watching {dir}\n')
+  finally:
+    if watcher is not None:
+      watcher.close()
+
+# kind is 'transferred', 'skipped', 'compiled', 'failed' or, last of all, 'done';
+# detail holds the exception for 'failed' and (compiled, skipped, failed) for 'done'
+BuildEvent = _namedtuple('BuildEvent', ['kind', 'source', 'target', 'detail'])
+
+async def async_build(dir:str, new_dir:str, *, indent_amount:int=1, erase_dir:bool=False,
+                      replace_previous:bool=False, transfer_other_files:bool=True,
+                      incremental:bool=False, executor=None):
+  # Builds like nbuild without blocking the event loop, yielding a BuildEvent for every
+  # file as it is handled. Nothing is ever asked: erase_dir and replace_previous are
+  # taken as given. Walking the tree and copying files run on the loop's default
+  # executor; transpiling runs on executor, or the default one if None. Pass a
+  # ProcessPoolExecutor to transpile on several cores.
+  import asyncio
+  loop = asyncio.get_running_loop()
+  queued, transfers, skipped, newManifest = await loop.run_in_executor(
+    None, _plan, dir, new_dir, indent_amount, erase_dir, replace_previous, transfer_other_files, incremental, None)
+  for source in skipped:
+    yield BuildEvent('skipped', source, None, None)
+
+  async def step(kind, source, target, executor, function, *args):
+    try:
+      result = await loop.run_in_executor(executor, function, *args)
+    except Exception as e:
+      return BuildEvent('failed', source, target, e), None
+    return BuildEvent(kind, source, target, None), result
+
+  tasks = [asyncio.ensure_future(step('transferred', source, new_file, None, _copyfile, source, new_file))
+           for source, new_file in transfers]
+  tasks += [asyncio.ensure_future(step('compiled', source, new_file, executor, _buildFile, source, new_file, *options))
+            for key, source, new_file, options in queued]
+  entries = {source: (key, options) for key, source, new_file, options in queued}
+  compiled = failed = 0
+  try:
+    for task in asyncio.as_completed(tasks):
+      event, digest = await task
+      if event.kind == 'failed':
+        failed += 1
+      elif event.kind == 'compiled':
+        compiled += 1
+        key, options = entries[event.source]
+        newManifest[key] = [digest, *options]
+      yield event
+  finally:
+    for task in tasks:
+      task.cancel()
+  if incremental:
+    await loop.run_in_executor(None, _saveManifest, new_dir, newManifest)
+  yield BuildEvent('done', dir, new_dir, (compiled, len(skipped), failed))
+
+async def async_ncompile(file:str, *, indent_amount:int=1, cythonic:bool=None, executor=None):
+  # ncompile on executor, or the loop's default one if None
+  import asyncio
+  return await asyncio.get_running_loop().run_in_executor(
+    executor, _partial(ncompile, file, indent_amount=indent_amount, cythonic=cythonic))
 
 def ncompile(file:str, *, indent_amount:int=1, cythonic:bool=None, tokenlog:bool=False):
   cythonic = _path.splitext(file)[~0] == '.npx' if cythonic is None else cythonic
-  with open(file, 'r', encoding='utf-8') as f:
-    return _m.ncompile(f.read(), indent_amount=indent_amount, cythonic=cythonic, tokenlog=tokenlog, filename=file)
+  with _mapFile(file) as data:
+    return _m.ncompile_bytes(data, indent_amount=indent_amount, cythonic=cythonic, tokenlog=tokenlog, filename=file)
 
-def nexec(file:str, *, indent_amount:int=1, cythonic:bool=None, tokenlog:bool=False):
+def nexec(file:str, *, indent_amount:int=1, cythonic:bool=None, tokenlog:bool=False, remap:bool=False):
   from . import imports as importHandler
   del importHandler
-  exec(ncompile(file, indent_amount=indent_amount, cythonic=cythonic, tokenlog=tokenlog))
\ No newline at end of file
+  if not remap:
+    exec(compile(ncompile(file, indent_amount=indent_amount, cythonic=cythonic, tokenlog=tokenlog), file, 'exec'))
+    return
+  cythonic = _path.splitext(file)[~0] == '.npx' if cythonic is None else cythonic
+  with open(file, 'r', encoding='utf-8') as f:
+    code = _m.ncompile_code(f.read(), file, indent_amount=indent_amount, cythonic=cythonic, tokenlog=tokenlog)
+  exec(code)
\ No newline at end of file
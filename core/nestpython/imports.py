@@ -1,25 +1,37 @@
+import _imp
 import importlib.abc as _iabc
-import importlib.machinery as _im
+import importlib.util as _iu
+import marshal as _marshal
+import os as _os
 import os.path as _path
-from . import main as _m
+import struct as _struct
+import sys as _sys
+from . import main as _m, __version__
 from sys import path as _syspath, meta_path as _metapath
-class NpyLoader(_iabc.SourceLoader):
-    def __init__(self, path):
-        self.path = path
 
-    def get_filename(self, fullname):
-        return self.path
+# Transpiled bytecode is cached next to the source in __pycache__, under a name that
+# carries the nestpython version and dialect, e.g. mod.npy.nestpython-1.0.0.cpython-311.pyc.
+# The header holds the interpreter magic number and the source's mtime and size.
+# Set NESTPYTHON_NOCACHE to any non-empty value to neither read nor write the cache.
 
-    def get_data(self, path):
-        with open(path, 'rb') as f:
-            return f.read()
+# With lazy set, modules found by MyFinder are loaded through importlib.util.LazyLoader:
+# importing one only creates it, and it is transpiled and executed on first attribute
+# access. Set it here, or set NESTPYTHON_LAZY to any non-empty value before importing.
 
-    def source_to_code(self, data, path=''):
-        source = data.decode('utf-8')
-        transpiled_source = _m.ncompile(source)
-        return compile(transpiled_source, path, 'exec')
+lazy = bool(_os.environ.get('NESTPYTHON_LAZY'))
+
+# With remap set, as it is by default, modules are compiled through main.ncompile_code,
+# so tracebacks point at the lines of the .npy rather than of the transpiled code.
+# Clear it here, or set NESTPYTHON_NOREMAP to any non-empty value before importing, to
+# compile the transpiled code as it is.
+
+remap = not _os.environ.get('NESTPYTHON_NOREMAP')
+
+_cacheHeader = _struct.Struct('<4sQQ')
+
+class _NLoader(_iabc.SourceLoader):
+    cythonic = False
 
-class NpxLoader(_iabc.SourceLoader):
     def __init__(self, path):
         self.path = path
 
@@ -30,12 +42,97 @@ class NpxLoader(_iabc.SourceLoader):
         with open(path, 'rb') as f:
             return f.read()
 
+    def path_stats(self, path):
+        st = _os.stat(path)
+        return {'mtime': st.st_mtime, 'size': st.st_size}
+
+    def set_data(self, path, data):
+        _os.makedirs(_path.dirname(path), exist_ok=True)
+        temp = f'{path}.{_os.getpid()}.tmp'
+        try:
+            with open(temp, 'wb') as f:
+                f.write(data)
+            _os.replace(temp, path)
+        except OSError:
+            try:
+                _os.unlink(temp)
+            except OSError:
+                pass
+
+    def cache_path(self, path):
+        head, tail = _path.split(path)
+        tag = f'nestpython-{__version__}{"x" if self.cythonic else ""}{"-remap" if remap else ""}.{_sys.implementation.cache_tag}'
+        return _path.join(head, '__pycache__', f'{tail}.{tag}.pyc')
+
+    def get_code(self, fullname):
+        path = self.get_filename(fullname)
+        if _os.environ.get('NESTPYTHON_NOCACHE') or _sys.implementation.cache_tag is None:
+            return self.source_to_code(self.get_data(path), path)
+        cache_path = self.cache_path(path)
+        st = _os.stat(path)
+        header = _cacheHeader.pack(_iu.MAGIC_NUMBER, st.st_mtime_ns, st.st_size)
+        try:
+            data = self.get_data(cache_path)
+        except OSError:
+            pass
+        else:
+            if data[:_cacheHeader.size] == header:
+                try:
+                    code = _marshal.loads(data[_cacheHeader.size:])
+                except (EOFError, ValueError, TypeError):
+                    pass
+                else:
+                    # the tree may have moved since the cache was written
+                    _imp._fix_co_filename(code, path)
+                    return code
+        code = self.source_to_code(self.get_data(path), path)
+        if not _sys.dont_write_bytecode:
+            self.set_data(cache_path, header + _marshal.dumps(code))
+        return code
+
     def source_to_code(self, data, path=''):
         source = data.decode('utf-8')
-        transpiled_source = _m.ncompile(source, cythonic=True)
-        return compile(transpiled_source, path, 'exec')
+        if remap:
+            return _m.ncompile_code(source, path, cythonic=self.cythonic)
+        return compile(_m.ncompile(source, cythonic=self.cythonic), path, 'exec')
+
+class NpyLoader(_NLoader):
+    cythonic = False
+
+class NpxLoader(_NLoader):
+    cythonic = True
+
+_loaders = (('.npy', NpyLoader), ('.npx', NpxLoader))
+
+def _spec(fullname, path, loader, **kwargs):
+    loader = loader(path)
+    return _iu.spec_from_file_location(fullname, path, loader=_iu.LazyLoader(loader) if lazy else loader, **kwargs)
 
 class MyFinder(_iabc.MetaPathFinder):
+    # Directory listings are kept in memory and only read again once the directory's
+    # mtime changes, like FileFinder; importlib.invalidate_caches() drops them all.
+
+    def __init__(self):
+        self._listings = {}
+
+    def _listing(self, dir_path):
+        try:
+            mtime = _os.stat(dir_path).st_mtime_ns
+        except OSError:
+            return frozenset()
+        cached = self._listings.get(dir_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        try:
+            listing = frozenset(_os.listdir(dir_path))
+        except OSError:
+            listing = frozenset()
+        self._listings[dir_path] = (mtime, listing)
+        return listing
+
+    def invalidate_caches(self):
+        self._listings.clear()
+
     def find_spec(self, fullname, path, target=None):
         module_name = fullname.rpartition('.')[-1]
 
@@ -46,18 +143,28 @@ class MyFinder(_iabc.MetaPathFinder):
             search_paths = path
 
         for dir_path in search_paths:
-            npy_path = _path.join(dir_path, module_name + '.npy')
-            if _path.isfile(npy_path):
-                loader = NpyLoader(npy_path)
-                return _im.ModuleSpec(fullname, loader)
+            if not isinstance(dir_path, str):
+                continue
 
-            npx_path = _path.join(dir_path, module_name + '.npx')
-            if _path.isfile(npx_path):
-                loader = NpxLoader(npx_path)
-                return _im.ModuleSpec(fullname, loader)
+            # '' is whatever the current directory is at the time
+            dir_path = dir_path or _os.getcwd()
+            listing = self._listing(dir_path)
+
+            # packages: a directory holding an __init__.npy (or .npx)
+            if module_name in listing:
+                package_path = _path.join(dir_path, module_name)
+                package_listing = self._listing(package_path)
+                for ext, loader in _loaders:
+                    if '__init__' + ext in package_listing:
+                        init_path = _path.join(package_path, '__init__' + ext)
+                        return _spec(fullname, init_path, loader, submodule_search_locations=[package_path])
+
+            for ext, loader in _loaders:
+                if module_name + ext in listing:
+                    module_path = _path.join(dir_path, module_name + ext)
+                    return _spec(fullname, module_path, loader)
 
         return None  # Not found
 
 # Insert your finder at the front of sys.meta_path
 _metapath.insert(0, MyFinder())
-
@@ -1,202 +1,1053 @@
-def ncompile(code:str, *, indent_amount:int=1, cythonic:bool=False, tokenlog:bool=False, filename:str=None):
-  import contextlib
-  import re
-  from collections.abc import Iterable
-  from enum import Enum
+import ast
+import codecs
+import contextlib
+import linecache
+import marshal
+import re
+import sys
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from collections.abc import Iterable
+from enum import Enum
+from functools import cache
+from hashlib import blake2b
+from itertools import count
+from time import perf_counter
+from types import CodeType
 
-  # canonicalize line breaks
+__all__ = ['CompileCache', 'CompileLimitError', 'CompileLimits', 'CompileStats', 'IncrementalResult', 'SourceMap',
+           'ncompile', 'ncompile_bytes', 'ncompile_code', 'ncompile_incremental', 'ncompile_many', 'ncompile_stream',
+           'nexec']
 
-  code = code.replace('\r\n', '\n').replace('\r', '\n')
+# ----------------- #
+#      TOKENS       #
+# ----------------- #
+
+def unpack(list):
+  out = []
+  for arg in list:
+    match arg:
+      case Iterable():
+        out += unpack(arg)
+      case _:
+        out.append(arg)
+  return out
+
+TokenTypes = Enum('TokenTypes', [
+  'SYNTACTICAL', 'MULTILINE',
+  'INDENTED', 'MAP', 'CYTHON',
+  'STRING', 'APPENDSUB', 'SHORTHAND',
+  'MACROS', 'ESCAPEMENT', 'NEWLINELIKE',
+  'EXTRA'
+])
+
+# every type as a bit, so the compiler tests a token's types with a single &
+
+def flag(types):
+  flags = 0
+  for type in types:
+    flags |= 1 << type.value
+  return flags
+
+SYNTACTICAL = flag([TokenTypes.SYNTACTICAL])
+MULTILINE = flag([TokenTypes.MULTILINE])
+INDENTED = flag([TokenTypes.INDENTED])
+MAP = flag([TokenTypes.MAP])
+STRING = flag([TokenTypes.STRING])
+APPENDSUB = flag([TokenTypes.APPENDSUB])
+SHORTHAND = flag([TokenTypes.SHORTHAND])
+MACROS = flag([TokenTypes.MACROS])
+NEWLINELIKE = flag([TokenTypes.NEWLINELIKE])
+
+_ids = count(1)
+
+class Token:
+  __slots__ = ('symb', 'types', 'flags', 'id')
+
+  def __init__(self, symb='', *types, setID=None):
+    self.symb = symb
+    types = unpack(types)
+    if TokenTypes.SHORTHAND in types and TokenTypes.MAP not in types:
+      types.append(TokenTypes.MAP)
+    self.types = tuple(types)
+    self.flags = flag(types)
+    self.id = next(_ids) if setID is None else setID
+
+  def lexeme(self, symb):
+    # a token of this kind holding symb; the types are shared rather than rebuilt
+    token = _newToken(Token)
+    token.symb = symb
+    token.types = self.types
+    token.flags = self.flags
+    token.id = self.id
+    return token
+
+_newToken = object.__new__
+_anon = Token(setID=-1)
+
+def anonToken(symb, *types):
+  return Token(symb, *types, setID=-1) if types else _anon.lexeme(symb)
+
+# TOKEN DECLARATIONS
+
+def linesafe(regex):
+  return r'\n*'.join(regex)
+
+def sclund(regex):
+  return r'\n*\b' + linesafe(regex) + r'_*\b'
+
+class Tokens:
+  escapeEscaped = Token(r'\\\\', TokenTypes.ESCAPEMENT)
+  escapeNewline = Token(r'\\\n', TokenTypes.INDENTED, TokenTypes.NEWLINELIKE)
+  escape = Token(r'\\', TokenTypes.ESCAPEMENT)
+  multilineStringDouble = Token(r'(?<!\\)"""', TokenTypes.STRING)
+  multilineStringSingle = Token(r"(?<!\\)'''", TokenTypes.STRING)
+  stringDouble = Token(r'\n*"', TokenTypes.STRING)
+  stringSingle = Token(r"\n*'", TokenTypes.STRING)
+  dictIndentLeft = Token(r'-{', TokenTypes.MAP)
+  dictIndentRight = Token(r'}-', TokenTypes.MAP)
+  indentLeftDouble = Token(r'{\n*{')
+  indentSelfClose = Token(r'{\s*(\/\/.*\n\s*|\/\*[\s\S]\*\/\s*)*}', TokenTypes.INDENTED, TokenTypes.SYNTACTICAL)
+  indentNoColonSelfClose = Token(r'~{\s*(\/\/.*\n\s*|\/\*[\s\S]\*\/\s*)*}', TokenTypes.INDENTED, TokenTypes.SYNTACTICAL)
+  indentLeftNoColon = Token(r'~{', TokenTypes.INDENTED, TokenTypes.SYNTACTICAL)
+  indentLeft = Token(r'{', TokenTypes.INDENTED, TokenTypes.SYNTACTICAL)
+  indentRight = Token(r'}', TokenTypes.INDENTED, TokenTypes.SYNTACTICAL)
+  andDeconflict = Token(sclund('and'), TokenTypes.APPENDSUB)
+  orDeconflict = Token(sclund('or'), TokenTypes.APPENDSUB)
+  cpdefDeconflict = Token(sclund('cpdef'), TokenTypes.APPENDSUB, TokenTypes.CYTHON)
+  cdefDeconflict = Token(sclund('cdef'), TokenTypes.APPENDSUB, TokenTypes.CYTHON)
+  notDeconflict = Token(sclund('not'), TokenTypes.APPENDSUB)
+  isDeconflict = Token(sclund('is'), TokenTypes.APPENDSUB)
+  defDeconflict = Token(sclund('def'), TokenTypes.APPENDSUB)
+  lambdaDeconflict = Token(sclund('lambda'), TokenTypes.APPENDSUB)
+  inDeconflict = Token(sclund('in'), TokenTypes.APPENDSUB)
+  returnDeconflict = Token(sclund('return'), TokenTypes.APPENDSUB)
+  yieldDeconflict = Token(sclund('yield'), TokenTypes.APPENDSUB)
+  caseDeconflict = Token(sclund('case'), TokenTypes.APPENDSUB)
+  delDeconflict = Token(sclund('del'), TokenTypes.APPENDSUB)
+  passDeconflict = Token(sclund('pass'), TokenTypes.APPENDSUB)
+  newline = Token(r'\n', TokenTypes.INDENTED, TokenTypes.MULTILINE, TokenTypes.NEWLINELIKE)
+  returnShorthand = Token(linesafe(r'=>'), TokenTypes.SHORTHAND)
+  yieldShorthand = Token(linesafe(r':>'), TokenTypes.SHORTHAND)
+  nativeSemicolon = Token(linesafe(r',,'), TokenTypes.MAP)
+  nativeAssignment = Token(linesafe(r'<-'), TokenTypes.MAP)
+  incrementOperator = Token(r'\+\n*\+', TokenTypes.MAP)
+  decrementOperator = Token(linesafe(r'--'), TokenTypes.MAP)
+  andShorthand = Token(linesafe(r'&&'), TokenTypes.SHORTHAND)
+  orShorthand = Token(r'\|\n*\|', TokenTypes.SHORTHAND)
+  isShorthand = Token(linesafe(r'=&'), TokenTypes.SHORTHAND)
+  isNotShorthand = Token(linesafe(r'!=&'), TokenTypes.SHORTHAND)
+  cpdefShorthand = Token(r'~\n*\$\n*=', TokenTypes.SHORTHAND, TokenTypes.CYTHON)
+  cdefShorthand = Token(r'\$\n*=', TokenTypes.SHORTHAND, TokenTypes.CYTHON)
+  defShorthand = Token(r':\n*=(?!\n*>)', TokenTypes.SHORTHAND)
+  returntypeShorthand = Token(linesafe(r'>:'), TokenTypes.SHORTHAND)
+  inShorthand = Token(linesafe(r'->'), TokenTypes.SHORTHAND)
+  notInShorthand = Token(linesafe(r'!>'), TokenTypes.SHORTHAND)
+  delShorthand = Token(linesafe(r'~>'), TokenTypes.SHORTHAND)
+  lambdaShorthand = Token(linesafe(r';='), TokenTypes.SHORTHAND)
+  indentNewline = Token(r';', TokenTypes.INDENTED, TokenTypes.SYNTACTICAL)
+  notShorthand = Token(r'!(?!=)', TokenTypes.SHORTHAND)
+  comment = Token(r'/\s*\*[\s\S]*?\*\s*/', TokenTypes.INDENTED)
+  lineComment = Token(r'/\s*/.*', TokenTypes.INDENTED)
+  lineStatement = Token(r'/\s*\|.*?\|\s*/', TokenTypes.INDENTED)
+  intDiv = Token(linesafe(r'~/'), TokenTypes.MAP)
+  caseShorthand = Token(r'\?', TokenTypes.SHORTHAND)
+  macroDefine = Token(r'#\s*[\w\n]+\s*#![\s\S]*?!#', TokenTypes.MACROS)
+  macroUndefine = Token(r'#~\s*[\w\n]+\s*~#', TokenTypes.MACROS)
+  macroIfdef = Token(r'#\?\s*[\w\n]*\s*\?#', TokenTypes.MACROS)
+  macroAccess = Token(r'\$[\w\n]*', TokenTypes.MACROS)
+  macro = Token('#', TokenTypes.SYNTACTICAL)
+
+# CONVERSION TOKEN MAPPING
+
+tokenMap = {
+    Tokens.dictIndentLeft.id: '{',
+    Tokens.dictIndentRight.id: '}',
+    Tokens.nativeSemicolon.id: ';',
+    Tokens.nativeAssignment.id: ':=',
+    Tokens.andShorthand.id: 'and',
+    Tokens.orShorthand.id: 'or',
+    Tokens.notShorthand.id: 'not',
+    Tokens.isShorthand.id: 'is',
+    Tokens.isNotShorthand.id: 'is not',
+    Tokens.defShorthand.id: 'def',
+    Tokens.inShorthand.id: 'in',
+    Tokens.caseShorthand.id: 'case',
+    Tokens.notInShorthand.id: 'not in',
+    Tokens.returnShorthand.id: 'return',
+    Tokens.lambdaShorthand.id: 'lambda',
+    Tokens.delShorthand.id: 'del',
+    Tokens.incrementOperator.id: '+=1',
+    Tokens.decrementOperator.id: '-=1',
+    Tokens.cpdefShorthand.id: 'cpdef',
+    Tokens.cdefShorthand.id: 'cdef',
+    Tokens.yieldShorthand.id: 'yield',
+    Tokens.intDiv.id: '//',
+    Tokens.returntypeShorthand.id: '->'
+}
+
+# token kinds by id, for statistics; text between tokens counts as 'text'
+
+tokenNames = {token.id: name for name, token in vars(Tokens).items() if isinstance(token, Token)}
+tokenNames[-1] = 'text'
+
+
+@cache
+def tokenList(cythonic, included=()):
+  return tuple(t for t in [k for h, k in Tokens.__dict__.items() if not h.startswith('__')]
+               if (TokenTypes.CYTHON not in t.types or cythonic) and ((TokenTypes.EXTRA in t.types) == (t.id in included)))
+
+# TOKENIZATION ALGORITHM
+
+_word = r'\w\x80-\xff'
+
+def binaryRegex(regex):
+  # The regex rewritten to run over UTF-8 bytes, where every non-ASCII byte counts as
+  # a word character. That matches the str regex on text whose non-ASCII characters
+  # are all alphanumeric (see binarySafe). Raises ValueError for classes it can't
+  # carry over.
+  regex = (regex.replace(r'[\w', '[' + _word)
+                .replace(r'(?<!\w)', f'(?<![{_word}])')
+                .replace(r'\b', f'(?:(?<![{_word}])(?=[{_word}])|(?<=[{_word}])(?![{_word}]))'))
+  if re.search(r'\\[dDWB]|\\w(?!\\x80)', regex):
+    raise ValueError(f'cannot match {regex!r} over bytes')
+  return regex.encode('ascii')
+
+_binaryUnsafe = re.compile(rb'\r|[\x80-\xff]+')
+
+def binarySafe(buffer):
+  # whether a binary grammar tokenizes the UTF-8 bytes in buffer exactly as the str
+  # grammar tokenizes their text: no \r to canonicalize, and no non-ASCII character
+  # that \w would not match
+  for match in _binaryUnsafe.finditer(buffer):
+    if match.group() == b'\r' or not str(match.group(), 'utf-8').isalnum():
+      return False
+  return True
+
+class Grammar:
+
+  def __init__(self, tokens, binary=False):
+    self.tokens = tokens
+    self.binary = binary
+    convert = binaryRegex if binary else str
+
+    # all tokens are folded into one alternation, tried in declaration order at
+    # every position; the group that matched tells which token it was
+
+    self.pattern = re.compile(convert('|'.join(f'({token.symb})' for token in tokens)), re.M)
+    self.groups = [None] * (self.pattern.groups + 1)
+    group = 1
+    for token in tokens:
+      self.groups[group] = token
+      group += re.compile(token.symb).groups + 1
+
+    # block comments and macro definitions are the only tokens that may run on
+    # for longer than a stream window; their openers tell when to read further
+    self.openers = re.compile(convert(r'/\s*\*|#\s*[\w\n]+\s*#!'))
+
+    # an opener with no closer after it only fails once the pattern has searched to
+    # the end of the text; no opener past the last closer can close, so the text
+    # after it is searched without that token (see stages), rather than to the end
+    # again for every opener
+    self.closers = [(token.id, re.compile(convert(f'[\\s\\S]*({closer})')))
+                    for token, closer in ((Tokens.comment, r'\*\s*/'), (Tokens.macroDefine, '!#')) if token in tokens]
+    self.reduced = {}
+
+    # every token starts with one of a few characters, or with a keyword at a word
+    # boundary; the pattern is only tried where one of those is found, so plain text
+    # is skipped in one search rather than trying every token at every character
+    starts = self.startPattern(tokens)
+    self.starts = None if starts is None else re.compile(convert(starts))
+    self.breaks = re.compile(convert(r'\n+'))
+
+  @staticmethod
+  def startPattern(tokens):
+    # a pattern matching wherever a token may start, or None if a symbol's first
+    # character can't be read off it
+    chars = set()
+    letters = set()
+    for token in tokens:
+      symb = token.symb.removeprefix(r'(?<!\\)')
+      if symb.startswith(r'\n*'):
+        chars.add('\n')
+        symb = symb[3:]
+      firsts = chars
+      if symb.startswith(r'\b'):
+        firsts = letters
+        symb = symb[2:]
+      if symb.startswith(r'\n'):
+        first = '\n'
+      elif symb[:1] == '\\' and len(symb) > 1 and not symb[1].isalnum():
+        first = symb[1]
+      elif symb and symb[0] not in '\\.^$*+?()[|':
+        first = symb[0]
+      else:
+        return None
+      if firsts is letters and not first.isalpha():
+        return None
+      firsts.add(first)
+    pattern = '[' + ''.join(re.escape(char) for char in sorted(chars)) + ']'
+    if letters:
+      pattern += r'|(?<!\w)[' + ''.join(sorted(letters)) + ']'
+    return pattern
+
+  def searcher(self):
+    # A search(string, i, end) for one scan, finding the first token starting at or
+    # after i and before end. The tokens starting with \n* only match at a line break
+    # by reading the whole run of them, so they are tried once per run, from its last
+    # line break; where none matches, the rest of the run is known to be newline
+    # tokens and each is matched against its one character.
+    if self.starts is None:
+      return self.pattern.search
+    match = self.pattern.match
+    starts = self.starts.search
+    breaks = self.breaks.match
+    plain = None
+    stop = 0
+
+    def search(string, i, end=sys.maxsize):
+      nonlocal plain, stop
+      while start := starts(string, i, end):
+        i = start.start()
+        if string is plain and i < stop:
+          return match(string, i, i + 1)
+        if run := breaks(string, i):
+          if match(string, run.end() - 1).end() > run.end():
+            return match(string, i)
+          plain = string
+          stop = run.end()
+          return match(string, i, i + 1)
+        if token := match(string, i):
+          return token
+        i += 1
+      return None
+
+    return search
+
+  def without(self, ids):
+    # this grammar without the tokens whose ids are in the frozenset ids
+    if not ids:
+      return self
+    if (grammar := self.reduced.get(ids)) is None:
+      grammar = self.reduced[ids] = Grammar(tuple(token for token in self.tokens if token.id not in ids), self.binary)
+    return grammar
+
+  def stages(self, string, pos=0):
+    # (end, grammar) pairs splitting string from pos: the tokens starting before end
+    # are found by grammar, which leaves out every run-on token with no closer left
+    # past the end of the previous stage
+    if self.starts is None:
+      return [(len(string), self)]
+    stages = []
+    dropped = frozenset()
+    for last, id in sorted((-1 if (match := closer.match(string, pos)) is None else match.start(1), id)
+                           for id, closer in self.closers):
+      stages.append((last + 1, self.without(dropped)))
+      dropped |= {id}
+    stages.append((len(string), self.without(dropped)))
+    return stages
+
+  def scan(self, string, pos=0):
+    i = pos
+    text = _anon.lexeme
+    for end, grammar in self.stages(string, pos):
+      groups = grammar.groups
+      search = grammar.searcher()
+      while match := search(string, i, end):
+        start = match.start()
+        if start > i:
+          yield text(string[i:start])
+        yield groups[match.lastindex].lexeme(match.group())
+        i = match.end()
+    if i < len(string):
+      yield text(string[i:])
+
+  def scanBuffer(self, buffer):
+    # scan() for a binary grammar, over the UTF-8 bytes of any bytes-like object;
+    # only the spans handed out are decoded
+    i = 0
+    text = _anon.lexeme
+    decode = codecs.utf_8_decode
+    for end, grammar in self.stages(buffer):
+      groups = grammar.groups
+      search = grammar.searcher()
+      while match := search(buffer, i, end):
+        start = match.start()
+        if start > i:
+          yield text(decode(buffer[i:start])[0])
+        i = match.end()
+        yield groups[match.lastindex].lexeme(decode(buffer[start:i])[0])
+    if i < len(buffer):
+      yield text(decode(buffer[i:])[0])
+
+  def tokenize(self, string):
+    return list(self.scan(string))
+
+  def stream(self, read, window=1 << 16):
+    # Tokenizes text pulled through read(size) while holding only a couple of windows
+    # of it. A token is only handed out once at least a window of text follows it, so
+    # the result equals tokenizing the whole text unless a single run of whitespace,
+    # word characters or one line is longer than a window. The character before pos,
+    # where the text still to tokenize starts, is kept for the lookbehinds.
+    buffer = ''
+    pos = 0
+    carriage = ''
+    eof = False
+    while True:
+      while not eof and len(buffer) < 2 * window:
+        data = read(window)
+        eof = not data
+        data = carriage + data
+
+        # canonicalize line breaks, holding back a \r that may start a \r\n
+
+        carriage = '\r' if data.endswith('\r') and not eof else ''
+        buffer += data.removesuffix(carriage).replace('\r\n', '\n').replace('\r', '\n')
+      if eof:
+        yield from self.scan(buffer, pos)
+        return
+      i = pos
+      limit = len(buffer) - window
+      opener = self.openers.search(buffer, pos)
+      for end, grammar in self.stages(buffer, pos):
+        groups = grammar.groups
+        search = grammar.searcher()
+        while match := search(buffer, i, end):
+          if match.end() > limit:
+            break
+          if opener is not None and opener.start() < i:
+            opener = self.openers.search(buffer, i)
+          if opener is not None and (opener.start() < match.start() or opener.start() == match.start()
+                                     and groups[match.lastindex].id not in (Tokens.comment.id, Tokens.macroDefine.id)):
+            break
+          if match.start() > i:
+            yield anonToken(buffer[i:match.start()])
+          yield groups[match.lastindex].lexeme(match.group())
+          i = match.end()
+        else:
+          continue
+        break
+      if i == pos:
+        window *= 2
+      else:
+        buffer = buffer[i - 1:]
+        pos = 1
+
+class TokenStream:
+  # tokens pulled lazily from an iterator; tokens handed back by the compiler are
+  # pushed onto the front of the queue, so nothing after them is ever copied
+
+  def __init__(self, tokens):
+    self.tokens = iter(tokens)
+    self.pending = deque()
+    self.pushes = 0
 
-  # ----------------- #
-  #      TOKENS       #
-  # ----------------- #
-
-  def unpack(list):
-    out = []
-    for arg in list:
-      match arg:
-        case Iterable():
-          out += unpack(arg)
-        case _:
-          out.append(arg)
-    return out
-
-  TokenTypes = Enum('TokenTypes', [
-    'SYNTACTICAL', 'MULTILINE',
-    'INDENTED', 'MAP', 'CYTHON',
-    'STRING', 'APPENDSUB', 'SHORTHAND',
-    'MACROS', 'ESCAPEMENT', 'NEWLINELIKE',
-    'EXTRA'
-  ])
-
-  id = 0
-
-  class Token:
-
-    def __init__(self, symb='', *types, setID=None):
-      self.symb = symb
-      self.types = unpack(types)
-      if TokenTypes.SHORTHAND in self.types and TokenTypes.MAP not in self.types:
-        self.types.append(TokenTypes.MAP)
-      if setID is None:
-        nonlocal id
-        id += 1
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    if self.pending:
+      return self.pending.popleft()
+    return next(self.tokens)
+
+  def peek(self, n=0):
+    while len(self.pending) <= n:
+      try:
+        self.pending.append(next(self.tokens))
+      except StopIteration:
+        raise IndexError('token stream exhausted') from None
+    return self.pending[n]
+
+  def push(self, tokens):
+    self.pushes += 1
+    self.pending.extendleft(reversed(tokens))
+
+  def drop(self, n):
+    for _ in range(n):
+      self.pending.popleft()
+
+class MacroTable:
+  # Every name maps to a stack of (indent level, body), innermost definition on top;
+  # every level keeps the names defined at it, so closing a scope only touches those.
+  # Definitions deeper than the current level are always dropped, so the top of a
+  # stack is the closest definition.
+
+  def __init__(self):
+    self.macros = {}
+    self.scopes = {}
+    self.version = 0
+
+  @classmethod
+  def restore(cls, snapshot):
+    table = cls()
+    for name, stack in snapshot.items():
+      table.macros[name] = list(stack)
+      for level, body in stack:
+        table.scopes.setdefault(level, []).append(name)
+    return table
+
+  def snapshot(self):
+    # every definition, as a plain dict that compares equal for equal tables
+    return {name: tuple(stack) for name, stack in self.macros.items()}
+
+  def define(self, name, level, body):
+    self.version += 1
+    stack = self.macros.setdefault(name, [])
+    if stack and stack[-1][0] == level:
+      stack[-1] = (level, body)
+    else:
+      stack.append((level, body))
+      self.scopes.setdefault(level, []).append(name)
+
+  def undefine(self, name, level):
+    stack = self.macros.get(name)
+    if not stack or stack[-1][0] != level:
+      raise KeyError((name, level))
+    self.version += 1
+    stack.pop()
+    self.scopes[level].remove(name)
+    if not stack:
+      del self.macros[name]
+
+  def lookup(self, name):
+    stack = self.macros.get(name)
+    if stack and stack[-1][0] >= 0:
+      return stack[-1][1]
+
+  def close(self, level):
+    for deeper in sorted((l for l in self.scopes if l > level), reverse=True):
+      self.version += 1
+      for name in self.scopes.pop(deeper):
+        stack = self.macros[name]
+        stack.pop()
+        if not stack:
+          del self.macros[name]
+
+class CompileStats:
+  # Where transpiling spent its time, in seconds per phase: tokenizing the source,
+  # emitting output, handling macros, and re-tokenizing text the compiler hands back
+  # to itself (comments inside strings, self-closing braces, macro bodies). The
+  # phases exclude each other and add up to the total. Source tokens are counted by
+  # kind, along with how often tokens were pushed back and macros expanded.
+  # Pass one to ncompile(..., stats=...); reusing it adds the runs up.
+
+  phases = ('tokenize', 'emit', 'macro', 'retokenize')
+
+  def __init__(self):
+    self.times = dict.fromkeys(self.phases, 0.0)
+    self.tokens = {}
+    self.characters = 0
+    self.pushbacks = 0
+    self.expansions = 0
+    self.runs = 0
+    self.phase = None
+    self.since = 0.0
+
+  @property
+  def total(self):
+    return sum(self.times.values())
+
+  def switch(self, phase):
+    # charges the time since the last switch to the current phase, then enters phase
+    now = perf_counter()
+    previous = self.phase
+    if previous is not None:
+      self.times[previous] += now - self.since
+    self.phase = phase
+    self.since = now
+    return previous
+
+  @contextlib.contextmanager
+  def timing(self, phase):
+    previous = self.switch(phase)
+    try:
+      yield
+    finally:
+      self.switch(previous)
+
+  def count(self, tokens):
+    # passes the tokens through, charging the time taken to produce them to tokenize
+    tokens = iter(tokens)
+    kinds = self.tokens
+    while True:
+      previous = self.switch('tokenize')
+      try:
+        token = next(tokens)
+      except StopIteration:
+        return
+      finally:
+        self.switch(previous)
+      kind = tokenNames.get(token.id, 'text')
+      kinds[kind] = kinds.get(kind, 0) + 1
+      self.characters += len(token.symb)
+      yield token
+
+  def merge(self, other):
+    for phase in self.phases:
+      self.times[phase] += other.times[phase]
+    for kind, n in other.tokens.items():
+      self.tokens[kind] = self.tokens.get(kind, 0) + n
+    self.characters += other.characters
+    self.pushbacks += other.pushbacks
+    self.expansions += other.expansions
+    self.runs += other.runs
+    return self
+
+  def report(self):
+    total = self.total or 1
+    lines = [f'{self.characters} characters, {sum(self.tokens.values())} tokens in {self.total * 1000:.1f}ms'
+             f' ({self.pushbacks} pushbacks, {self.expansions} macro expansions)']
+    lines.append('  ' + ', '.join(f'{phase} {self.times[phase] * 1000:.1f}ms ({self.times[phase] / total:.0%})'
+                                  for phase in self.phases))
+    lines.append('  ' + ', '.join(f'{kind} {n}' for kind, n in sorted(self.tokens.items(), key=lambda item: -item[1])))
+    return '\n'.join(lines)
+
+class CompileLimitError(Exception):
+  # Raised when transpiling goes over one of its CompileLimits, or a macro is used
+  # inside its own expansion. limit names the bound that was hit ('max_input',
+  # 'max_output', 'max_expansions', 'max_depth', 'timeout' or 'recursion');
+  # offset, lineno and col_offset tell how far into the source transpiling had got.
+
+  def __init__(self, message, limit, offset, lineno, col_offset, filename=None):
+    where = '' if filename is None else f'{filename}, '
+    super().__init__(f'{message} ({where}line {lineno}, column {col_offset + 1})')
+    self.message = message
+    self.limit = limit
+    self.offset = offset
+    self.lineno = lineno
+    self.col_offset = col_offset
+    self.filename = filename
+
+  def __reduce__(self):
+    # rebuilt from its fields, so it can be pickled back from a worker process
+    return type(self), (self.message, self.limit, self.offset, self.lineno, self.col_offset, self.filename)
+
+class CompileLimits:
+  # Bounds on a single transpile, for input that can't be trusted; None leaves a
+  # bound off. max_input and max_output count characters, max_expansions counts
+  # macro uses, max_depth bounds how deeply they nest, and timeout is in seconds of
+  # wall-clock time. With limits, a macro used inside its own expansion fails at
+  # once instead of expanding forever. Pass one as limits=...
+
+  def __init__(self, *, max_input:int=None, max_output:int=None, max_expansions:int=None, max_depth:int=None,
+               timeout:float=None):
+    self.max_input = max_input
+    self.max_output = max_output
+    self.max_expansions = max_expansions
+    self.max_depth = max_depth
+    self.timeout = timeout
+
+class _LimitGuard:
+  # enforces CompileLimits over one transpile, keeping the position of the latest
+  # source token for its errors
+
+  def __init__(self, limits, filename):
+    self.limits = limits
+    self.filename = filename
+    self.deadline = None if limits.timeout is None else perf_counter() + limits.timeout
+    self.offset = 0
+    self.lineno = 1
+    self.col_offset = 0
+    self.expansions = 0
+
+    # every token of a macro body maps to the body (by id, as bodies are tokenized
+    # once and kept), and every body to the one whose token expanded it last; walking
+    # up from a token gives the expansions it is nested in
+
+    self.origins = {}
+    self.parents = {}
+
+  def fail(self, message, limit):
+    raise CompileLimitError(message, limit, self.offset, self.lineno, self.col_offset, self.filename)
+
+  def clock(self):
+    if self.deadline is not None and perf_counter() > self.deadline:
+      self.fail(f'transpiling took longer than {self.limits.timeout}s', 'timeout')
+
+  def track(self, tokens):
+    max_input = self.limits.max_input
+    for token in tokens:
+      self.clock()
+      symb = token.symb
+      if max_input is not None and self.offset + len(symb) > max_input:
+        self.fail(f'source is longer than {max_input} characters', 'max_input')
+      yield token
+      self.offset += len(symb)
+      if (lines := symb.count('\n')):
+        self.lineno += lines
+        self.col_offset = len(symb) - symb.rfind('\n') - 1
       else:
-        id = setID
-      self.id = id
+        self.col_offset += len(symb)
+
+  def expand(self, token, name, body, expansion):
+    limits = self.limits
+    self.expansions += 1
+    if limits.max_expansions is not None and self.expansions > limits.max_expansions:
+      self.fail(f'more than {limits.max_expansions} macro expansions', 'max_expansions')
+    parent = self.origins.get(id(token))
+    depth = 1
+    outer = parent
+    while outer is not None:
+      if outer == body:
+        self.fail(f'macro {name!r} is used inside its own expansion', 'recursion')
+      depth += 1
+      outer = self.parents.get(outer)
+    if limits.max_depth is not None and depth > limits.max_depth:
+      self.fail(f'macro expansions nested more than {limits.max_depth} deep', 'max_depth')
+    if body not in self.parents:
+      for inner in expansion:
+        self.origins[id(inner)] = body
+    self.parents[body] = parent
+    self.clock()
+
+  def output(self, size):
+    if self.limits.max_output is not None and size > self.limits.max_output:
+      self.fail(f'output is longer than {self.limits.max_output} characters', 'max_output')
+    self.clock()
+
+class SourceMap:
+  # Maps offsets in the transpiled output back to offsets in the source (with line
+  # breaks canonicalized), one entry per token that starts at a new output offset.
+  # Pass one to ncompile(..., sourcemap=...), then remap_code() the compiled output
+  # so it reports source lines, or remap() the parsed output for lines and columns.
+
+  def __init__(self):
+    self.output = array('q')
+    self.source = array('q')
+    self.position = 0
+
+  def track(self, tokens):
+    # passes the source tokens through, keeping position at the start of the latest
+    position = 0
+    for token in tokens:
+      self.position = position
+      position += len(token.symb)
+      yield token
+
+  def mark(self, offset):
+    # output from offset on comes from the current source position; entries at or
+    # past offset are dropped, as the output they marked was stripped or empty
+    output = self.output
+    while output and output[-1] >= offset:
+      output.pop()
+      self.source.pop()
+    output.append(offset)
+    self.source.append(self.position)
+
+  def locator(self, source, output):
+    # returns position(lineno, col) translating a 1-based output line and UTF-8 byte
+    # column, as the ast module reports them, into the matching source ones
+    source = source.replace('\r\n', '\n').replace('\r', '\n')
+    sourceLines = source.split('\n')
+    sourceStarts = [0]
+    for line in sourceLines:
+      sourceStarts.append(sourceStarts[-1] + len(line) + 1)
+    outputLines = output.split('\n')
+    outputStarts = [0]
+    for line in outputLines:
+      outputStarts.append(outputStarts[-1] + len(line) + 1)
+    last = len(source)
+    starts = self.output
+    offsets = self.source
+
+    # an output offset maps to the source through the entry it falls in; tokens gain
+    # or lose leading blanks on the way out, so offsets within one are counted from
+    # its first non-blank character on both sides, with the blanks of the entries
+    # that have any kept as (output blanks, source blanks)
+
+    blank = re.compile(r'[ \t]*')
+    blanks = (' ', '\t')
+    blanked = {}
+    for entry, (start, offset) in enumerate(zip(starts, offsets)):
+      if output[start:start + 1] in blanks or source[offset:offset + 1] in blanks:
+        end = starts[entry + 1] if entry + 1 < len(starts) else len(output) + 1
+        blanked[entry] = (min(blank.match(output, start).end() - start, end - start),
+                          blank.match(source, offset).end() - offset)
+    lastLine = len(sourceLines)
+
+    def position(lineno, col):
+      line = outputLines[lineno - 1]
+      if not line.isascii():
+        col = len(line.encode('utf-8')[:col].decode('utf-8', 'ignore'))
+      at = outputStarts[lineno - 1] + col
+      entry = bisect_right(starts, at) - 1
+      if entry < 0:
+        offset = 0
+      else:
+        offset = offsets[entry] + at - starts[entry]
+        if entry in blanked:
+          outputBlank, sourceBlank = blanked[entry]
+          delta = at - starts[entry]
+          offset += min(delta, sourceBlank) - delta if delta < outputBlank else sourceBlank - outputBlank
+        if offset > last:
+          offset = last
+      lineno = bisect_right(sourceStarts, offset, 0, lastLine)
+      col = offset - sourceStarts[lineno - 1]
+      line = sourceLines[lineno - 1]
+      if not line.isascii():
+        col = len(line[:col].encode('utf-8'))
+      return lineno, col
+
+    position.lines = sourceLines
+    return position
+
+  def remap(self, tree, source, output):
+    # rewrites the locations of tree, parsed from output, to point into source
+    position = self.locator(source, output)
+
+    # the same nodes as ast.walk, without its generators
+
+    AST = ast.AST
+    nodes = [tree]
+    while nodes:
+      node = nodes.pop()
+      for field in node._fields:
+        child = getattr(node, field, None)
+        if isinstance(child, AST):
+          nodes.append(child)
+        elif isinstance(child, list):
+          nodes += [item for item in child if isinstance(item, AST)]
+      if 'lineno' not in node._attributes:
+        continue
+      start = node.lineno, node.col_offset = position(node.lineno, node.col_offset)
+      if node.end_lineno is not None:
+        node.end_lineno, node.end_col_offset = max(position(node.end_lineno, node.end_col_offset), start)
+    return tree
+
+  def remap_error(self, error, source, output):
+    # points a SyntaxError raised on output at the source instead
+    if error.lineno is None or not 0 < error.lineno <= output.count('\n') + 1:
+      return error
+    position = self.locator(source, output)
+    line = output.split('\n')[error.lineno - 1]
+    col = len(line[:max((error.offset or 1) - 1, 0)].encode('utf-8'))
+    error.lineno, col = position(error.lineno, col)
+    error.text = position.lines[error.lineno - 1]
+    error.offset = len(error.text.encode('utf-8')[:col].decode('utf-8', 'ignore')) + 1
+    error.end_lineno = error.end_offset = None
+    return error
+
+  def lines(self, source, output):
+    # the source line of every 1-based output line, as an array: the line of its
+    # first character that isn't blank, found as locator's position() would
+    source = source.replace('\r\n', '\n').replace('\r', '\n')
+    sourceStarts = [0, *(match.end() for match in re.finditer('\n', source))]
+    last = len(source)
+    starts = self.output
+    offsets = self.source
+    blank = re.compile(r'[ \t]*').match
+    table = array('q', [0])
+    at = 0
+    while True:
+      at = blank(output, at).end()
+      entry = bisect_right(starts, at) - 1
+      if entry < 0:
+        offset = 0
+      else:
+
+        # the blanks the entry starts with can't reach past at, which isn't blank
 
-    # TOKENIZATION ALGORITHM
+        start = starts[entry]
+        offset = offsets[entry]
+        offset += at - blank(output, start).end() + blank(source, offset).end() - offset
+        if offset > last:
+          offset = last
+      table.append(bisect_right(sourceStarts, offset))
+      at = output.find('\n', at) + 1
+      if not at:
+        return table
 
-  def anonToken(symb, *types):
-    return Token(symb, *types, setID=-1)
+  def remap_code(self, code, source, output):
+    # rewrites the line numbers of code, compiled from output, to point into source;
+    # columns are dropped, as they would count into the transpiled lines
+    return _relined(code, self.lines(source, output))
+
+def _varint(table, value):
+  while value >= 64:
+    table.append(64 | value & 63)
+    value >>= 6
+  table.append(value)
+
+def _relined(code, lines):
+  # code and the code objects among its constants, with every line number n moved to
+  # lines[n], written out in the interpreter's line table format
+  first = lines[code.co_firstlineno]
+  table = bytearray()
+  previous = first
+
+  # (length, line) of each run of bytecode on one line
+
+  spans = []
+  length = 0
+  current = None
+  for start, end, line in code.co_lines():
+    if line is not None:
+      line = lines[line]
+    if line != current and length:
+      spans.append((length, current))
+      length = 0
+    current = line
+    length += end - start
+  if length:
+    spans.append((length, current))
+
+  if sys.version_info >= (3, 11):
+
+    # entries of up to 8 code units, each with the line's signed delta (code 13), or
+    # with no location (code 15)
+
+    for length, line in spans:
+      units = length // 2
+      while units:
+        size = min(units, 8)
+        units -= size
+        if line is None:
+          table.append(0xf8 | size - 1)
+        else:
+          table.append(0xe8 | size - 1)
+          delta = line - previous
+          previous = line
+          _varint(table, -delta << 1 | 1 if delta < 0 else delta << 1)
+  else:
+
+    # (bytecode delta, line delta) byte pairs, -128 for no line
+
+    for length, line in spans:
+      if line is None:
+        delta = -128
+      else:
+        delta = line - previous
+        previous = line
+        while delta > 127:
+          table += bytes((0, 127))
+          delta -= 127
+        while delta < -127:
+          table += bytes((0, 129))
+          delta += 127
+      while length > 254:
+        table += bytes((254, delta & 255))
+        delta = -128 if line is None else 0
+        length -= 254
+      table += bytes((length, delta & 255))
+
+  consts = tuple(_relined(const, lines) if isinstance(const, CodeType) else const for const in code.co_consts)
+  return code.replace(co_firstlineno=first, co_linetable=bytes(table), co_consts=consts)
+
+class CompileCache:
+  # An opt-in, bounded LRU of transpiled text (ncompile) and code objects
+  # (ncompile_code, nexec), keyed by a hash of the source and the options used. The
+  # least recently used entries go once there are more than maxsize of them, or they
+  # take more than maxbytes: the output's length, or the marshalled size of a code
+  # object. Pass one as cache=...; it may be shared between threads.
+
+  def __init__(self, maxsize:int=256, maxbytes:int=1 << 24):
+    self.maxsize = maxsize
+    self.maxbytes = maxbytes
+    self.entries = OrderedDict()
+    self.bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def key(kind, code, *options):
+    return (kind, blake2b(code.encode('utf-8', 'surrogatepass'), digest_size=16).digest(), *options)
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return None
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+  def put(self, key, value, size):
+    with self.lock:
+      if key in self.entries:
+        self.bytes -= self.entries.pop(key)[1]
+      if size <= self.maxbytes:
+        self.entries[key] = (value, size)
+        self.bytes += size
+      while len(self.entries) > self.maxsize or self.bytes > self.maxbytes:
+        self.bytes -= self.entries.popitem(last=False)[1][1]
+    return value
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.bytes = 0
+      self.hits = 0
+      self.misses = 0
+
+  def info(self):
+    return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.bytes,
+            'maxsize': self.maxsize, 'maxbytes': self.maxbytes}
+
+# grammars are built once per configuration, on first use, and shared by every
+# ncompile call
+
+@cache
+def grammar(cythonic, included=(), binary=False):
+  return Grammar(tokenList(cythonic, included), binary)
+
+_boundaries = (Tokens.indentRight.id, Tokens.indentNewline.id)
+
+
+def _ncompile(tokens, write, *, indent_amount, cythonic, tokenlog, filename, size=None, stats=None, sourcemap=None,
+              resume=None, checkpoint=None, limits=None):
+  # Transpiles the tokens, handing the output to write() in pieces. Only the tail
+  # of the output that can still be rstripped stays in memory. resume is a state
+  # handed to checkpoint(token, previous, tail, macros), which is called before
+  # every token that follows a top-level ; or } outside any string.
+
+  if sourcemap is not None:
+    tokens = sourcemap.track(tokens)
+  if stats is not None:
+    stats.runs += 1
+    stats.phase = None
+    stats.switch('emit')
+    tokens = stats.count(tokens)
+    timing = stats.timing
+  else:
+    timing = lambda phase: contextlib.nullcontext()
+  guard = None
+  if limits is not None:
+    guard = _LimitGuard(limits, filename)
+    tokens = guard.track(tokens)
 
   tokens_parsed = 0
   string_parsed = 0
+  tokenGrammar = grammar(cythonic)
 
-  def tokenize(string, tokens: list[Token], buffer, tokenlog, filename):
+  def logged(tokenized, size):
     nonlocal string_parsed
     nonlocal tokens_parsed
-    tokenized = []
-    i = 0
-    j = 0
-    def update(token):
-      nonlocal tokenized
-      nonlocal string
-      nonlocal tokenlog
-      nonlocal string_parsed
-      nonlocal tokens_parsed
-      tokenized.append(token)
+    for token in tokenized:
       string_parsed += len(token.symb)
       tokens_parsed += 1
-      if tokenlog:
-        print(f'tokenmatch \u2116{tokens_parsed}; {string_parsed / len(string) * 100:.2f}% of string{f" {filename}" if filename is not None else ""} parsed')
-    while i + j < len(string):
-      for token in tokens:
-        F = (i + j - buffer >= 0)
-        if match := re.match(
-            fr'[\s\S]{{{buffer}}}{token.symb}' if F else token.symb,
-            string[i + j - buffer:] if F else string, re.M):
-          match_string = match.group()[buffer:] if F else match.group()
-          if string[i:i + j] != '':
-            update(anonToken(string[i:i + j]))
-          update(Token(match_string, token.types, setID=token.id))
-          i += j + len(match_string)
-          j = -1
-          break
-      j += 1
-    if i < len(string):
-      update(anonToken(string[i:]))
-    return tokenized
-
-  # TOKEN DECLARATIONS
-
-  def linesafe(regex):
-    return r'\n*'.join(regex)
-
-  def sclund(regex):
-    return r'\n*\b' + linesafe(regex) + r'_*\b'
-
-  macros = {}
-
-  class Tokens:
-    escapeEscaped = Token(r'\\\\', TokenTypes.ESCAPEMENT)
-    escapeNewline = Token(r'\\\n', TokenTypes.INDENTED, TokenTypes.NEWLINELIKE)
-    escape = Token(r'\\', TokenTypes.ESCAPEMENT)
-    multilineStringDouble = Token(r'(?<!\\)"""', TokenTypes.STRING)
-    multilineStringSingle = Token(r"(?<!\\)'''", TokenTypes.STRING)
-    stringDouble = Token(r'\n*"', TokenTypes.STRING)
-    stringSingle = Token(r"\n*'", TokenTypes.STRING)
-    dictIndentLeft = Token(r'-{', TokenTypes.MAP)
-    dictIndentRight = Token(r'}-', TokenTypes.MAP)
-    indentLeftDouble = Token(r'{\n*{')
-    indentSelfClose = Token(r'{\s*(\/\/.*\n\s*|\/\*[\s\S]\*\/\s*)*}', TokenTypes.INDENTED, TokenTypes.SYNTACTICAL)
-    indentNoColonSelfClose = Token(r'~{\s*(\/\/.*\n\s*|\/\*[\s\S]\*\/\s*)*}', TokenTypes.INDENTED, TokenTypes.SYNTACTICAL)
-    indentLeftNoColon = Token(r'~{', TokenTypes.INDENTED, TokenTypes.SYNTACTICAL)
-    indentLeft = Token(r'{', TokenTypes.INDENTED, TokenTypes.SYNTACTICAL)
-    indentRight = Token(r'}', TokenTypes.INDENTED, TokenTypes.SYNTACTICAL)
-    andDeconflict = Token(sclund('and'), TokenTypes.APPENDSUB)
-    orDeconflict = Token(sclund('or'), TokenTypes.APPENDSUB)
-    cpdefDeconflict = Token(sclund('cpdef'), TokenTypes.APPENDSUB, TokenTypes.CYTHON)
-    cdefDeconflict = Token(sclund('cdef'), TokenTypes.APPENDSUB, TokenTypes.CYTHON)
-    notDeconflict = Token(sclund('not'), TokenTypes.APPENDSUB)
-    isDeconflict = Token(sclund('is'), TokenTypes.APPENDSUB)
-    defDeconflict = Token(sclund('def'), TokenTypes.APPENDSUB)
-    lambdaDeconflict = Token(sclund('lambda'), TokenTypes.APPENDSUB)
-    inDeconflict = Token(sclund('in'), TokenTypes.APPENDSUB)
-    returnDeconflict = Token(sclund('return'), TokenTypes.APPENDSUB)
-    yieldDeconflict = Token(sclund('yield'), TokenTypes.APPENDSUB)
-    caseDeconflict = Token(sclund('case'), TokenTypes.APPENDSUB)
-    delDeconflict = Token(sclund('del'), TokenTypes.APPENDSUB)
-    passDeconflict = Token(sclund('pass'), TokenTypes.APPENDSUB)
-    newline = Token(r'\n', TokenTypes.INDENTED, TokenTypes.MULTILINE, TokenTypes.NEWLINELIKE)
-    returnShorthand = Token(linesafe(r'=>'), TokenTypes.SHORTHAND)
-    yieldShorthand = Token(linesafe(r':>'), TokenTypes.SHORTHAND)
-    nativeSemicolon = Token(linesafe(r',,'), TokenTypes.MAP)
-    nativeAssignment = Token(linesafe(r'<-'), TokenTypes.MAP)
-    incrementOperator = Token(r'\+\n*\+', TokenTypes.MAP)
-    decrementOperator = Token(linesafe(r'--'), TokenTypes.MAP)
-    andShorthand = Token(linesafe(r'&&'), TokenTypes.SHORTHAND)
-    orShorthand = Token(r'\|\n*\|', TokenTypes.SHORTHAND)
-    isShorthand = Token(linesafe(r'=&'), TokenTypes.SHORTHAND)
-    isNotShorthand = Token(linesafe(r'!=&'), TokenTypes.SHORTHAND)
-    cpdefShorthand = Token(r'~\n*\$\n*=', TokenTypes.SHORTHAND, TokenTypes.CYTHON)
-    cdefShorthand = Token(r'\$\n*=', TokenTypes.SHORTHAND, TokenTypes.CYTHON)
-    defShorthand = Token(r':\n*=(?!\n*>)', TokenTypes.SHORTHAND)
-    returntypeShorthand = Token(linesafe(r'>:'), TokenTypes.SHORTHAND)
-    inShorthand = Token(linesafe(r'->'), TokenTypes.SHORTHAND)
-    notInShorthand = Token(linesafe(r'!>'), TokenTypes.SHORTHAND)
-    delShorthand = Token(linesafe(r'~>'), TokenTypes.SHORTHAND)
-    lambdaShorthand = Token(linesafe(r';='), TokenTypes.SHORTHAND)
-    indentNewline = Token(r';', TokenTypes.INDENTED, TokenTypes.SYNTACTICAL)
-    notShorthand = Token(r'!(?!=)', TokenTypes.SHORTHAND)
-    comment = Token(r'/\s*\*[\s\S]*?\*\s*/', TokenTypes.INDENTED)
-    lineComment = Token(r'/\s*/.*', TokenTypes.INDENTED)
-    lineStatement = Token(r'/\s*\|.*?\|\s*/', TokenTypes.INDENTED)
-    intDiv = Token(linesafe(r'~/'), TokenTypes.MAP)
-    caseShorthand = Token(r'\?', TokenTypes.SHORTHAND)
-    macroDefine = Token(r'#\s*[\w\n]+\s*#![\s\S]*?!#', TokenTypes.MACROS)
-    macroUndefine = Token(r'#~\s*[\w\n]+\s*~#', TokenTypes.MACROS)
-    macroIfdef = Token(r'#\?\s*[\w\n]*\s*\?#', TokenTypes.MACROS)
-    macroAccess = Token(r'\$[\w\n]*', TokenTypes.MACROS)
-    macro = Token('#', TokenTypes.SYNTACTICAL)
-
-    # CONVERSION TOKEN MAPPING
-
-  tokenMap = {
-      Tokens.dictIndentLeft.id: '{',
-      Tokens.dictIndentRight.id: '}',
-      Tokens.nativeSemicolon.id: ';',
-      Tokens.nativeAssignment.id: ':=',
-      Tokens.andShorthand.id: 'and',
-      Tokens.orShorthand.id: 'or',
-      Tokens.notShorthand.id: 'not',
-      Tokens.isShorthand.id: 'is',
-      Tokens.isNotShorthand.id: 'is not',
-      Tokens.defShorthand.id: 'def',
-      Tokens.inShorthand.id: 'in',
-      Tokens.caseShorthand.id: 'case',
-      Tokens.notInShorthand.id: 'not in',
-      Tokens.returnShorthand.id: 'return',
-      Tokens.lambdaShorthand.id: 'lambda',
-      Tokens.delShorthand.id: 'del',
-      Tokens.incrementOperator.id: '+=1',
-      Tokens.decrementOperator.id: '-=1',
-      Tokens.cpdefShorthand.id: 'cpdef',
-      Tokens.cdefShorthand.id: 'cdef',
-      Tokens.yieldShorthand.id: 'yield',
-      Tokens.intDiv.id: '//',
-      Tokens.returntypeShorthand.id: '->'
-  }
+      print(f'tokenmatch \u2116{tokens_parsed}; {f"{string_parsed / size * 100:.2f}%" if size else f"{string_parsed} characters"} of string{f" {filename}" if filename is not None else ""} parsed')
+      yield token
+
+  def tokenize(string):
+    with timing('retokenize'):
+      tokenized = tokenGrammar.tokenize(string)
+    return list(logged(tokenized, len(string))) if tokenlog else tokenized
+
+  macros = MacroTable() if resume is None else resume[2]
+  expansions = {}
 
   def isF(token, ptoken):
     with contextlib.suppress(TypeError):
-      return (TokenTypes.STRING in token.types) and (ptoken.symb[-1].rstrip('\n').lower() == 'f' or
+      return (token.flags & STRING) and (ptoken.symb[-1].rstrip('\n').lower() == 'f' or
                                                      ptoken.symb[-2:].replace('\n','').lower() == 'fr')
 
   def isR(token, ptoken):
     with contextlib.suppress(TypeError):
-      return (TokenTypes.STRING in token.types) and (ptoken.symb[-1].rstrip('\n').lower() == 'r' or
+      return (token.flags & STRING) and (ptoken.symb[-1].rstrip('\n').lower() == 'r' or
                                                      ptoken.symb[-2:].replace('\n','').lower() == 'rf')
 
   def isEscape(token):
@@ -210,7 +1061,7 @@ def ncompile(code:str, *, indent_amount:int=1, cythonic:bool=False, tokenlog:boo
   def isNRawEscape(token):
     return isEscape(token) and not in_rstring
 
-  compiled_code = ''
+  compiled_code = '' if resume is None else resume[1]
   indent_level = 0
   string_nesting = []
   def getStringType():
@@ -226,7 +1077,6 @@ def ncompile(code:str, *, indent_amount:int=1, cythonic:bool=False, tokenlog:boo
                                 in_multilineStringDouble())
   in_string = False
   compilable = lambda: not in_string
-  tokenList = lambda included=[]: [t for t in [k for h, k in Tokens.__dict__.items() if not h.startswith('__')] if (TokenTypes.CYTHON not in t.types or cythonic) and ((TokenTypes.EXTRA in t.types) == (t.id in included))]
 
   def string_compilable(token):
     match token.id:
@@ -240,12 +1090,8 @@ def ncompile(code:str, *, indent_amount:int=1, cythonic:bool=False, tokenlog:boo
         return not (in_multilineString() or in_stringSingle())
 
   indent = ' ' * indent_amount
-  buffer = 1
-  tokens = tokenize(code, tokenList(), buffer, tokenlog, filename)
-  compiling = True
-  ptoken = Token()
-  class breakout(Exception):
-    pass
+  tokens = TokenStream(logged(tokens, size) if tokenlog else tokens)
+  previous = anonToken('') if resume is None else resume[0]
 
   def string_compile(token):
     nonlocal in_string
@@ -255,187 +1101,480 @@ def ncompile(code:str, *, indent_amount:int=1, cythonic:bool=False, tokenlog:boo
       string_nesting.append(token)
     in_string = not in_string
 
-  def compile(bufferToken):
-    nonlocal compiled_code
-    nonlocal indent_level
-    nonlocal in_multilineStringSingle
-    nonlocal in_multilineStringDouble
-    nonlocal in_stringSingle
-    nonlocal in_stringDouble
-    nonlocal in_fstring
-    nonlocal in_rstring
-    nonlocal fstring_nesting
-    nonlocal in_multilineString
-    nonlocal in_string
-    nonlocal compilable
-    nonlocal indent
-    nonlocal tokens
-    nonlocal buffer
-    nonlocal compiling
-    nonlocal ptoken
-    nonlocal cythonic
-    try:
-     for n, token in enumerate(tokens):
-      ptoken = tokens[n - 1] if n > 0 else bufferToken
+  # output is written out once compiled_code grows past flushing, up to the last
+  # character that isn't blank, which the compiler may still strip; flushing waits
+  # for the rest to double first, so a long blank tail isn't rstripped for every
+  # token. This stays inline: a closure over compiled_code would make it a cell,
+  # and += on a cell copies the whole string every time.
+
+  written = 0
+  flushing = 1 << 13
+
+  for token in tokens:
+    ptoken = previous
+    previous = token
+    if len(compiled_code) > flushing:
+      keep = len(compiled_code.rstrip()) - 1
+      if keep > 0:
+        write(compiled_code[:keep])
+        compiled_code = compiled_code[keep:]
+        written += keep
+      flushing = max(1 << 13, 2 * len(compiled_code))
+      if guard is not None:
+        guard.output(written + len(compiled_code))
+    if sourcemap is not None:
+      sourcemap.mark(written + len(compiled_code))
+    if (checkpoint is not None and ptoken.id in _boundaries and indent_level == 0 and not in_string
+        and not string_nesting and not fstring_nesting and not in_fstring and not tokens.pending):
+      checkpoint(token, ptoken, compiled_code, macros)
+    if compilable():
+      match token.id:
+        case Tokens.comment.id | Tokens.lineComment.id:
+          continue
+        case Tokens.lineStatement.id:
+          compiled_code += '#' + token.symb[2:-2].rstrip() + '\n' + indent * indent_level
+          continue
+    elif token.id == Tokens.comment.id or token.id == Tokens.lineComment.id:
+      tokens.push(tokenize(token.symb[0]) + tokenize(token.symb[1:]))
+      previous = ptoken
+      continue
+    if in_string and token.id == Tokens.escapeNewline.id:
+      tokens.pending[0] = Token(tokens.peek().symb.lstrip())
+      previous = ptoken
+      continue
+    if token.id == Tokens.indentLeftDouble.id:
+      if in_fstring:
+        compiled_code += '{{'
+        continue
+      elif in_multilineString():
+        compiled_code += token.symb
+        continue
+      else:
+        tokens.push([Tokens.indentLeft]*2)
+        previous = ptoken
+        continue
+    if token.id == Tokens.indentSelfClose.id:
       if compilable():
+        compiled_code = (compiled_code.rstrip()
+                         + f':\n{indent * (indent_level+1)}\
+pass\n{indent * indent_level}')
+        continue
+      else:
+        tokens.push([Tokens.indentLeft]
+        + tokenize(token.symb[1:-1])
+        + [Tokens.indentRight])
+        previous = ptoken
+        continue
+    if token.flags & MACROS and compilable():
+      with timing('macro'):
         match token.id:
-          case Tokens.comment.id | Tokens.lineComment.id:
+          case Tokens.macroDefine.id:
+            macro = token.symb.split('#', 2)[1].strip().replace('\n', '')
+            sub = token.symb.split('#', 2)[2][1:-2]
+
+            macros.define(macro, indent_level, sub)
             continue
-          case Tokens.lineStatement.id:
-            compiled_code += '#' + token.symb[2:-2].rstrip() + '\n' + indent * indent_level
+          case Tokens.macroUndefine.id:
+            macro = token.symb.split('#')[1][1:-1].strip().replace('\n', '')
+            macros.undefine(macro, indent_level)
             continue
-      elif token.id == Tokens.comment.id or token.id == Tokens.lineComment.id:
-        tokens = tokenize(token.symb[0], tokenList(), buffer,
-                            tokenlog, filename) + tokenize(token.symb[1:], tokenList(), buffer,
-                            tokenlog, filename) + tokens[n + 1:]
-        raise breakout
-      if in_string and token.id == Tokens.escapeNewline.id:
-        tokens = [Token(tokens[n+1].symb.lstrip())] + tokens[n+2:]
-        raise breakout
-      if token.id == Tokens.indentLeftDouble.id:
-        if in_fstring:
-          compiled_code += '{{'
-          continue
-        elif in_multilineString():
+          case Tokens.macroIfdef.id:
+            macro = token.symb.split('#')[1][1:-1].strip().replace('\n', '')
+            truth = macros.lookup(macro) is not None
+            if compiled_code[-1] != ' ' and compiled_code[-1] != '\n':
+              compiled_code += ' '
+            compiled_code += str(truth) + ' '
+            continue
+          case Tokens.macroAccess.id:
+            if compilable():
+              macro = token.symb[1:].replace('\n', '')
+              if (sub := macros.lookup(macro)) is not None:
+
+                # a definition is tokenized once, however often it is used
+
+                if sub not in expansions:
+                  expansions[sub] = tokenize(sub)
+                if guard is not None:
+                  guard.expand(token, macro, sub, expansions[sub])
+                if stats is not None:
+                  stats.expansions += 1
+                tokens.push(expansions[sub])
+                previous = ptoken
+              continue
+            else:
+              compiled_code += (token.symb if in_multilineString()
+                                else token.symb.replace('\n', ''))
+    if token.flags & STRING and string_compilable(token):
+      if not isNRawEscape(ptoken):
+        string_compile(token)
+      in_fstring = in_string and isF(token, ptoken)
+      in_rstring = in_string and isR(token, ptoken)
+      compiled_code += token.symb.lstrip('\n')
+      continue
+    if compilable():
+     if fstring_nesting == 0:
+      match token.id:
+        case Tokens.indentLeft.id | Tokens.indentLeftNoColon.id:
+          indent_level += 1
+          compiled_code = compiled_code.rstrip()
+          compiled_code += ((':' if token.id == Tokens.indentLeft.id
+                            else (
+                              f'\n{indent * (indent_level-1)}while True:'
+                            )) + '\n' + indent * indent_level
+                           )
+        case Tokens.indentRight.id:
+          indent_level -= 1
+          macros.close(indent_level)
+          compiled_code += '\n' + indent * indent_level
+        case Tokens.indentNewline.id:
+          compiled_code += '\n' + indent * indent_level
+     elif token.id == Tokens.indentRight.id:
+      fstring_nesting -= 1
+      in_fstring = True
+      in_string = True
+
+    elif in_fstring:
+      match token.id:
+        case Tokens.indentLeft.id:
+          in_fstring = False
+          in_string = False
+          fstring_nesting += 1
           compiled_code += token.symb
-          continue
-        else:
-          tokens = [Tokens.indentLeft]*2 + tokens[n + 1:]
-          raise breakout
-      if token.id == Tokens.indentSelfClose.id:
-        if compilable():
-          compiled_code = (compiled_code.rstrip()
-                           + f':\n{indent * (indent_level+1)}\
-pass\n{indent * indent_level}')
-          continue
-        else:
-          tokens = ([Tokens.indentLeft]
-          + tokenize(token.symb[1:-1], tokenList(), buffer, tokenlog=tokenlog, filename=filename)
-          + [Tokens.indentRight]
-          + tokens[n + 1:])
-          raise breakout
-      if TokenTypes.MACROS in token.types and compilable():
-       match token.id:
-        case Tokens.macroDefine.id:
-          macro = (token.symb.split('#', 2)[1].strip().replace('\n', ''), indent_level)
-          sub = token.symb.split('#', 2)[2][1:-2]
-
-          macros.update({macro: sub})
-          continue
-        case Tokens.macroUndefine.id:
-          macro = (token.symb.split('#')[1][1:-1].strip().replace('\n', ''), indent_level)
-          macros.pop(macro)
-          continue
-        case Tokens.macroIfdef.id:
-          macro = token.symb.split('#')[1][1:-1].strip().replace('\n', '')
-          truth = False
-          for N in reversed(range(indent_level+1)):
-            if (macro, N) in macros:
-              truth = True
-              break
-          if compiled_code[-1] != ' ' and compiled_code[-1] != '\n':
-            compiled_code += ' '
-          compiled_code += str(truth) + ' '
-          continue
-        case Tokens.macroAccess.id:
-          if compilable():
-            macro = token.symb[1:].replace('\n', '')
-            for N in reversed(range(indent_level+1)):
-              if (nmacro := (macro, N)) in macros:
-                macro = macros[nmacro]
-                tokens = tokenize(macro, tokenList(), buffer, tokenlog=tokenlog, filename=filename) + tokens[n + 1:]
-                raise breakout
+        case Tokens.indentRight.id:
+          N = 0
+          while tokens.peek(N).id == Tokens.newline.id:
+            N += 1
+          if tokens.peek(N).id == token.id:
+            compiled_code += token.symb * 2
+            tokens.drop(N + 1)
+            previous = ptoken
             continue
-          else:
-            compiled_code += (token.symb if in_multilineString()
-                              else token.symb.replace('\n', ''))
-      if TokenTypes.STRING in token.types and string_compilable(token):
-        if not isNRawEscape(ptoken):
-          string_compile(token)
-        in_fstring = in_string and isF(token, ptoken)
-        in_rstring = in_string and isR(token, ptoken)
-        compiled_code += token.symb.lstrip('\n')
-        continue
+    if (not (token.flags & SYNTACTICAL and compilable())
+        and not (token.flags & MULTILINE and not in_multilineString())):
+
+      mtoken = tokenMap[token.id] if (token.flags & MAP
+                                      and compilable()) else token.symb
       if compilable():
-       if fstring_nesting == 0:
-        match token.id:
-          case Tokens.indentLeft.id | Tokens.indentLeftNoColon.id:
-            indent_level += 1
-            compiled_code = compiled_code.rstrip()
-            compiled_code += ((':' if token.id == Tokens.indentLeft.id
-                              else (
-                                f'\n{indent * (indent_level-1)}while True:'
-                              )) + '\n' + indent * indent_level
-                             )
-          case Tokens.indentRight.id:
-            indent_level -= 1
-            for macro in list(macros):
-              if int(macro[-1]) > indent_level:
-                macros.pop(macro)
-            compiled_code += '\n' + indent * indent_level
-          case Tokens.indentNewline.id:
-            compiled_code += '\n' + indent * indent_level
-       elif token.id == Tokens.indentRight.id:
-        fstring_nesting -= 1
-        in_fstring = True
-        in_string = True
-
-      elif in_fstring:
-        match token.id:
-          case Tokens.indentLeft.id:
-            in_fstring = False
-            in_string = False
-            fstring_nesting += 1
-            compiled_code += token.symb
-          case Tokens.indentRight.id:
-            N=1
-            while True:
-              if tokens[n+N].id == token.id:
-                compiled_code += token.symb * 2
-                tokens = tokens[n + N + 1:]
-                raise breakout
-              if tokens[n+N].id != Tokens.newline.id: break
-              N += 1
-      if (not (TokenTypes.SYNTACTICAL in token.types and compilable())
-          and not (TokenTypes.MULTILINE in token.types and not in_multilineString())):
-
-        mtoken = tokenMap[token.id] if (TokenTypes.MAP in token.types
-                                        and compilable()) else token.symb
-        if compilable():
-          if TokenTypes.APPENDSUB in token.types:
-            if re.search(r'\w$',tokens[n-1].symb.rstrip('\n')):
-              compiled_code += mtoken.replace('\n','')
-              continue
-            mtoken = mtoken.replace('\n','')
-            mtoken += '_'
-          if TokenTypes.SHORTHAND in token.types:
-            mtoken = mtoken.replace('\n','')
-            mtoken += ' '
-            if compiled_code != '':
-              if compiled_code[-1] != ' ' and compiled_code[-1] != '\n':
-                compiled_code += ' '
-          if TokenTypes.MAP in token.types:
-            mtoken = mtoken.replace('\n', '')
-        compiled_code += (mtoken.lstrip() if (
+        if token.flags & APPENDSUB:
+          if re.search(r'\w$',ptoken.symb.rstrip('\n')):
+            compiled_code += mtoken.replace('\n','')
+            continue
+          mtoken = mtoken.replace('\n','')
+          mtoken += '_'
+        if token.flags & SHORTHAND:
+          mtoken = mtoken.replace('\n','')
+          mtoken += ' '
+          if compiled_code != '':
+            if compiled_code[-1] != ' ' and compiled_code[-1] != '\n':
+              compiled_code += ' '
+        if token.flags & MAP:
+          mtoken = mtoken.replace('\n', '')
+      compiled_code += (mtoken.lstrip() if (
+                           (
                              (
-                               (
-                                    TokenTypes.INDENTED in ptoken.types
-                                 or TokenTypes.SHORTHAND in ptoken.types
-                               ) and compilable()
-                             ) or (
-                               not in_multilineString()
-                               and TokenTypes.NEWLINELIKE in ptoken.types
-                             )
-                           ) else mtoken
-                         )
-     compiled_code += '\n'
-     compiling = False
-    except breakout:
-      pass
-  while compiling:
-    compile(ptoken)
-  return compiled_code
-
-
-def nexec(code:str, indent_amount:int=1, *, cythonic:bool=False, tokenlog:bool=False, filename:str=None):
-  exec(ncompile(code, indent_amount=indent_amount, cythonic=cythonic, tokenlog=tokenlog, filename=filename))
+                                  ptoken.flags & INDENTED
+                               or ptoken.flags & SHORTHAND
+                             ) and compilable()
+                           ) or (
+                             not in_multilineString()
+                             and ptoken.flags & NEWLINELIKE
+                           )
+                         ) else mtoken
+                       )
+  compiled_code += '\n'
+  if guard is not None:
+    guard.output(written + len(compiled_code))
+  write(compiled_code)
+  if stats is not None:
+    stats.pushbacks += tokens.pushes
+    stats.switch(None)
+
+
+def ncompile(code:str, *, indent_amount:int=1, cythonic:bool=False, tokenlog:bool=False, filename:str=None,
+             stats:CompileStats=None, sourcemap:SourceMap=None, cache:CompileCache=None, limits:CompileLimits=None):
+
+  # a source map is only filled while transpiling, so it bypasses the cache; limits
+  # only bound transpiles that actually run
+
+  if cache is not None and sourcemap is None:
+    key = CompileCache.key('text', code, indent_amount, cythonic)
+    if (compiled := cache.get(key)) is not None:
+      return compiled
+    compiled = ncompile(code, indent_amount=indent_amount, cythonic=cythonic, tokenlog=tokenlog, filename=filename,
+                        stats=stats, limits=limits)
+    return cache.put(key, compiled, len(compiled))
+
+  # canonicalize line breaks
+
+  code = code.replace('\r\n', '\n').replace('\r', '\n')
+
+  compiled = []
+  _ncompile(grammar(cythonic).scan(code), compiled.append, indent_amount=indent_amount, cythonic=cythonic,
+            tokenlog=tokenlog, filename=filename, size=len(code), stats=stats, sourcemap=sourcemap, limits=limits)
+  return ''.join(compiled)
+
+def ncompile_stream(reader, writer, *, indent_amount:int=1, cythonic:bool=False, tokenlog:bool=False, filename:str=None,
+                    window:int=1 << 16, stats:CompileStats=None, sourcemap:SourceMap=None, limits:CompileLimits=None):
+  # Transpiles text read from the reader (anything with read(size)) into the writer
+  # (anything with write(str)) as it goes, holding a few windows of source and a
+  # bounded piece of output rather than the whole file.
+  _ncompile(grammar(cythonic).stream(reader.read, window), writer.write, indent_amount=indent_amount,
+            cythonic=cythonic, tokenlog=tokenlog, filename=filename, stats=stats, sourcemap=sourcemap, limits=limits)
+
+class _BufferReader:
+  # read(size) over the UTF-8 text in a bytes-like object, decoded a piece at a time
+
+  def __init__(self, buffer):
+    self.view = memoryview(buffer)
+    self.i = 0
+    self.decoder = codecs.getincrementaldecoder('utf-8')()
+
+  def read(self, size):
+    chunk = self.view[self.i:self.i + max(size, 4)]
+    self.i += len(chunk)
+    return self.decoder.decode(chunk, final=not chunk)
+
+def ncompile_bytes(data, writer=None, *, indent_amount:int=1, cythonic:bool=False, tokenlog:bool=False,
+                   filename:str=None, stats:CompileStats=None, sourcemap:SourceMap=None, limits:CompileLimits=None):
+  # Transpiles UTF-8 source held in any bytes-like object, such as an mmap of the
+  # file, without decoding it whole: the bytes are tokenized in place and only the
+  # spans handed to the compiler are decoded. Sources a binary grammar can't take
+  # (see binarySafe) are decoded a window at a time and streamed instead. The output
+  # goes to writer.write() if a writer is given, and is returned otherwise.
+  if binarySafe(data):
+    reader = None
+    tokens = grammar(cythonic, binary=True).scanBuffer(data)
+  else:
+    reader = _BufferReader(data)
+    tokens = grammar(cythonic).stream(reader.read)
+  compiled = []
+  try:
+    _ncompile(tokens, compiled.append if writer is None else writer.write, indent_amount=indent_amount,
+              cythonic=cythonic, tokenlog=tokenlog, filename=filename, size=len(data), stats=stats,
+              sourcemap=sourcemap, limits=limits)
+  finally:
+
+    # let go of data, so an mmap of it can be closed
+
+    tokens.close()
+    if reader is not None:
+      reader.view.release()
+  if writer is None:
+    return ''.join(compiled)
+
+
+# INCREMENTAL TRANSPILING
+
+# no token ending more than this many characters before an edit looks into it,
+# apart from block comments, line statements and macro definitions, which are
+# only ever closed by these
+_lookahead = 8
+_closers = re.compile(r'\*/|\|/|!#')
+
+class _Resynced(Exception):
+  pass
+
+class IncrementalResult:
+  # The output of ncompile_incremental, along with the points between top-level
+  # statements where transpiling can pick up again: their offsets into source and
+  # output, and the transpiler's state there. changed is the range of output that
+  # the latest edit rewrote.
+
+  def __init__(self, source, output, options, sources, outputs, states, changed):
+    self.source = source
+    self.output = output
+    self.options = options
+    self.sources = sources
+    self.outputs = outputs
+    self.states = states
+    self.changed = changed
+
+  def edit(self, start:int, end:int, text:str):
+    # The result for source[start:end] replaced by text. Transpiling resumes at the
+    # last top-level statement before the edit and stops at the first one after it
+    # where the state (the previous token, the output tail and the macro table)
+    # matches the one recorded there, splicing in the old output from that point.
+    # An edit that may close a comment or macro definition opened before it is
+    # transpiled from scratch.
+    indent_amount, cythonic = self.options
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    source = self.source[:start] + text + self.source[end:]
+    if _closers.search(source, max(start - 2, 0), start + len(text) + 2):
+      return ncompile_incremental(source, indent_amount=indent_amount, cythonic=cythonic)
+
+    # a line statement or comment runs to the end of its line, which the edit may
+    # have joined to the next, and its opener may be split over blank lines; resuming
+    # before the line above the edit (and any blank ones between) tokenizes any that
+    # the edit touches from scratch
+
+    lineStart = source.rfind('\n', 0, start) + 1
+    while lineStart > 0:
+      above = source.rfind('\n', 0, lineStart - 1) + 1
+      blank = not source[above:lineStart - 1].strip()
+      lineStart = above
+      if not blank:
+        break
+    first = bisect_right(self.sources, min(start - _lookahead, lineStart)) - 1
+    if first < 0:
+      pos, resume, prefix = 0, None, 0
+    else:
+      previous, tail, snapshot = self.states[first]
+      pos, resume, prefix = self.sources[first], (previous, tail, MacroTable.restore(snapshot)), self.outputs[first]
+    delta = len(text) - (end - start)
+    after = bisect_left(self.sources, end + _lookahead)
+    resynced = None
+    def stop(at, state):
+      nonlocal resynced
+      if at - delta < end + _lookahead:
+        return False
+      i = bisect_left(self.sources, at - delta, after)
+      if i < len(self.sources) and self.sources[i] == at - delta and _sameState(self.states[i], state):
+        resynced = i
+        return True
+      return False
+    output, sources, outputs, states = _incrementalRun(source, pos, resume, prefix, indent_amount, cythonic, stop)
+    output = self.output[:prefix] + output
+    changed = (prefix, len(output))
+    if resynced is not None:
+      shift = len(output) - self.outputs[resynced]
+      output += self.output[self.outputs[resynced]:]
+      sources.extend(at + delta for at in self.sources[resynced:])
+      outputs.extend(at + shift for at in self.outputs[resynced:])
+      states.extend(self.states[resynced:])
+    return IncrementalResult(source, output, self.options, self.sources[:first + 1] + sources,
+                             self.outputs[:first + 1] + outputs, self.states[:first + 1] + states, changed)
+
+def _sameState(state, other):
+  return (state[0].id == other[0].id and state[0].symb == other[0].symb and state[1] == other[1]
+          and state[2] == other[2])
+
+def _incrementalRun(source, pos, resume, prefix, indent_amount, cythonic, stop=None):
+  # Transpiles source from pos on, starting in the state resume, and collects the
+  # checkpoints past pos, with output offsets counted from prefix. Stops early at
+  # the first checkpoint stop(offset, state) accepts, returning the output up to it.
+  pieces = []
+  written = 0
+  last = [None, pos]
+  version = -1
+  snapshot = None
+  sources = array('q')
+  outputs = array('q')
+  states = []
+
+  def write(piece):
+    nonlocal written
+    pieces.append(piece)
+    written += len(piece)
+
+  def scan():
+    for token in grammar(cythonic).scan(source, pos):
+      last[0] = token
+      yield token
+      last[1] += len(token.symb)
+
+  def checkpoint(token, previous, tail, macros):
+    nonlocal version, snapshot
+    if token is not last[0] or last[1] == pos:
+      return
+    if macros.version != version:
+      version, snapshot = macros.version, macros.snapshot()
+    keep = max(len(tail.rstrip()) - 1, 0)
+    state = (previous, tail[keep:], snapshot)
+    if stop is not None and stop(last[1], state):
+      pieces.append(tail[:keep])
+      raise _Resynced
+    sources.append(last[1])
+    outputs.append(prefix + written + keep)
+    states.append(state)
+
+  with contextlib.suppress(_Resynced):
+    _ncompile(scan(), write, indent_amount=indent_amount, cythonic=cythonic, tokenlog=False, filename=None,
+              resume=resume, checkpoint=checkpoint)
+  return ''.join(pieces), sources, outputs, states
+
+def ncompile_incremental(code:str, *, indent_amount:int=1, cythonic:bool=False):
+  # ncompile, returning an IncrementalResult whose output can be updated for an edit
+  # with .edit(start, end, text) without transpiling the whole source again
+  code = code.replace('\r\n', '\n').replace('\r', '\n')
+  output, sources, outputs, states = _incrementalRun(code, 0, None, 0, indent_amount, cythonic)
+  return IncrementalResult(code, output, (indent_amount, cythonic), sources, outputs, states, (0, len(output)))
+
+
+def _ncompileBatch(sources, indent_amount, cythonic):
+  results = []
+  for code in sources:
+    try:
+      results.append(ncompile(code, indent_amount=indent_amount, cythonic=cythonic))
+    except Exception as e:
+      results.append(e)
+  return results
+
+def ncompile_many(sources:Iterable[str], *, workers:int=1, indent_amount:int=1, cythonic:bool=False,
+                  chunksize:int=256):
+  # Transpiles every source and returns the outputs in order; a source that fails
+  # has the exception it raised in its place instead. workers > 1 fans batches of
+  # chunksize sources out over that many processes, workers=None over one per core;
+  # each process builds the grammar once and keeps it for every batch it gets.
+  sources = list(sources)
+  if workers == 1 or len(sources) <= chunksize:
+    return _ncompileBatch(sources, indent_amount, cythonic)
+  chunks = [sources[i:i + chunksize] for i in range(0, len(sources), chunksize)]
+  from concurrent.futures import ProcessPoolExecutor
+  with ProcessPoolExecutor(workers) as pool:
+    batches = pool.map(_ncompileBatch, chunks, [indent_amount] * len(chunks), [cythonic] * len(chunks))
+    return [result for batch in batches for result in batch]
+
+
+def ncompile_code(code:str, filename:str=None, *, indent_amount:int=1, cythonic:bool=False, tokenlog:bool=False,
+                  stats:CompileStats=None, cache:CompileCache=None, limits:CompileLimits=None):
+  # Transpiles and compiles code into a code object whose line numbers point into
+  # code. The output is compiled as text, then its line table is remapped through
+  # a SourceMap.
+  if cache is not None:
+    key = CompileCache.key('code', code, indent_amount, cythonic, filename)
+    if (compiled := cache.get(key)) is not None:
+      return compiled
+    compiled = ncompile_code(code, filename, indent_amount=indent_amount, cythonic=cythonic, tokenlog=tokenlog,
+                             stats=stats, limits=limits)
+    return cache.put(key, compiled, len(marshal.dumps(compiled)))
+  sourcemap = SourceMap()
+  output = ncompile(code, indent_amount=indent_amount, cythonic=cythonic, tokenlog=tokenlog, filename=filename,
+                    stats=stats, sourcemap=sourcemap, limits=limits)
+  try:
+    compiled = compile(output, '<string>' if filename is None else filename, 'exec', dont_inherit=True)
+  except SyntaxError as e:
+    raise sourcemap.remap_error(e, code, output)
+  return sourcemap.remap_code(compiled, code, output)
+
+def nexec(code:str, indent_amount:int=1, *, cythonic:bool=False, tokenlog:bool=False, filename:str=None,
+          stats:CompileStats=None, cache:CompileCache=None, limits:CompileLimits=None, remap:bool=False):
+  # With remap, the code is compiled through ncompile_code, so tracebacks point into
+  # it rather than into its transpiled output.
+  if not remap:
+
+    # the cache keeps the code object, so a repeated call only hashes, looks up and
+    # executes
+
+    if cache is not None:
+      key = CompileCache.key('exec', code, indent_amount, cythonic, filename)
+      if (compiled := cache.get(key)) is not None:
+        exec(compiled)
+        return
+    compiled = compile(ncompile(code, indent_amount=indent_amount, cythonic=cythonic, tokenlog=tokenlog,
+                                filename=filename, stats=stats, limits=limits),
+                       '<string>' if filename is None else filename, 'exec')
+    if cache is not None:
+      cache.put(key, compiled, len(marshal.dumps(compiled)))
+    exec(compiled)
+    return
+  if filename is not None:
+
+    # tracebacks read the lines of filename through linecache, so they show this code,
+    # its last line terminated as linecache does for files
+
+    lines = code.splitlines(True)
+    if lines and not lines[-1].endswith('\n'):
+      lines[-1] += '\n'
+    linecache.cache[filename] = (len(code), None, lines, filename)
+  exec(ncompile_code(code, filename, indent_amount=indent_amount, cythonic=cythonic, tokenlog=tokenlog,
+                     stats=stats, cache=cache, limits=limits))
@@ -0,0 +1,246 @@
+# Transpile server: python -m nestpython.server [--socket PATH] [--workers N]
+#
+# Answers JSON-RPC 2.0 requests, one JSON object per line, on stdin/stdout or on a
+# Unix socket, so editors and build tools can transpile without starting Python for
+# every file. The grammars stay built, and recent results are kept in a CompileCache
+# keyed by a hash of the source (and, for diagnostics, its path). Requests run
+# concurrently on a thread pool, so responses may come back out of order; each
+# carries the id of its request.
+#
+# Methods, with params by name:
+#   transpile    source or path, cythonic, indent_amount  -> {"output": str}
+#   diagnostics  source or path, cythonic, indent_amount  -> {"diagnostics": [...]}
+#   stats                                                 -> the cache's info()
+#   shutdown                                              -> null, then the server exits
+# cythonic defaults to whether path ends in .npx. Each diagnostic has a message and
+# the lineno, offset, end_lineno and end_offset of the error in the source, which
+# are null when the transpiler itself failed. Every transpile runs under the
+# CompileLimits set by --timeout, --max-input and --max-output, so a source that
+# goes over one, or uses a macro inside its own expansion, fails with its position
+# instead of holding up a worker; the error's data then holds the limit and the
+# lineno and offset it was hit at.
+
+import argparse as _argparse
+import json as _json
+import os as _os
+import socket as _socket
+import socketserver as _socketserver
+import sys as _sys
+import threading as _threading
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
+from itertools import count as _count
+
+from . import __version__, main as _m
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+TRANSPILE_ERROR = -32000
+
+class ServerError(Exception):
+  # an error response, as raised by Client; data is the error's data member, if any
+
+  def __init__(self, code, message, data=None):
+    super().__init__(message)
+    self.code = code
+    self.data = data
+
+class Server:
+
+  def __init__(self, workers:int=None, cache:_m.CompileCache=None, limits:_m.CompileLimits=None):
+    self.cache = _m.CompileCache() if cache is None else cache
+    self.limits = limits
+    self.pool = _ThreadPoolExecutor(workers)
+    self.stopped = _threading.Event()
+    self.methods = {
+      'transpile': self.transpile,
+      'diagnostics': self.diagnostics,
+      'stats': self.stats,
+    }
+
+  @staticmethod
+  def _source(source=None, path=None, cythonic=None, indent_amount=1):
+    if source is None:
+      if path is None:
+        raise ServerError(INVALID_PARAMS, 'source or path is required')
+      with open(path, 'r', encoding='utf-8') as f:
+        source = f.read()
+    if cythonic is None:
+      cythonic = path is not None and path.endswith('.npx')
+    return source, path, bool(cythonic), int(indent_amount)
+
+  def transpile(self, **params):
+    source, path, cythonic, indent_amount = self._source(**params)
+    try:
+      output = _m.ncompile(source, indent_amount=indent_amount, cythonic=cythonic, filename=path, cache=self.cache,
+                           limits=self.limits)
+    except _m.CompileLimitError as e:
+      raise ServerError(TRANSPILE_ERROR, f'{type(e).__name__}: {e}',
+                        {'limit': e.limit, 'lineno': e.lineno, 'offset': e.col_offset + 1})
+    except Exception as e:
+      raise ServerError(TRANSPILE_ERROR, f'{type(e).__name__}: {e}')
+    return {'output': output}
+
+  def diagnostics(self, **params):
+    source, path, cythonic, indent_amount = self._source(**params)
+    key = self.cache.key('diagnostics', source, path, indent_amount, cythonic)
+    if (diagnostics := self.cache.get(key)) is None:
+      try:
+        _m.ncompile_code(source, path, indent_amount=indent_amount, cythonic=cythonic, limits=self.limits)
+        diagnostics = []
+      except _m.CompileLimitError as e:
+        diagnostics = [{'message': str(e), 'lineno': e.lineno, 'offset': e.col_offset + 1,
+                        'end_lineno': e.lineno, 'end_offset': e.col_offset + 1}]
+      except SyntaxError as e:
+        diagnostics = [{'message': e.msg, 'lineno': e.lineno, 'offset': e.offset,
+                        'end_lineno': e.end_lineno, 'end_offset': e.end_offset}]
+      except Exception as e:
+        diagnostics = [{'message': f'{type(e).__name__}: {e}', 'lineno': None, 'offset': None,
+                        'end_lineno': None, 'end_offset': None}]
+      self.cache.put(key, diagnostics, sum(len(diagnostic['message']) for diagnostic in diagnostics))
+    return {'diagnostics': diagnostics}
+
+  def stats(self):
+    return self.cache.info()
+
+  def respond(self, request):
+    # the response to a decoded request, or None for a notification
+    id = request.get('id') if isinstance(request, dict) else None
+    try:
+      if not isinstance(request, dict) or not isinstance(request.get('method'), str):
+        raise ServerError(INVALID_REQUEST, 'invalid request')
+      method = self.methods.get(request['method'])
+      if method is None:
+        raise ServerError(METHOD_NOT_FOUND, f'no method {request["method"]!r}')
+      params = request.get('params', {})
+      if not isinstance(params, dict):
+        raise ServerError(INVALID_PARAMS, 'params must be an object')
+      try:
+        response = {'jsonrpc': '2.0', 'id': id, 'result': method(**params)}
+      except (TypeError, ValueError) as e:
+        raise ServerError(INVALID_PARAMS, str(e))
+      except OSError as e:
+        raise ServerError(INVALID_PARAMS, f'{type(e).__name__}: {e}')
+    except ServerError as e:
+      response = {'jsonrpc': '2.0', 'id': id, 'error': {'code': e.code, 'message': str(e)}}
+      if e.data is not None:
+        response['error']['data'] = e.data
+    return None if isinstance(request, dict) and 'id' not in request else response
+
+  def serve(self, reader, writer):
+    # Answers the requests read line by line from reader (a binary file) on writer
+    # until EOF or a shutdown request. Returns once every response is written.
+    lock = _threading.Lock()
+    def send(response):
+      if response is not None:
+        data = _json.dumps(response).encode('utf-8') + b'\n'
+        with lock:
+          writer.write(data)
+          writer.flush()
+    pending = []
+    for line in reader:
+      if not line.strip():
+        continue
+      try:
+        request = _json.loads(line)
+      except ValueError as e:
+        send({'jsonrpc': '2.0', 'id': None, 'error': {'code': PARSE_ERROR, 'message': str(e)}})
+        continue
+      if isinstance(request, dict) and request.get('method') == 'shutdown':
+        for future in pending:
+          future.result()
+        send({'jsonrpc': '2.0', 'id': request.get('id'), 'result': None} if 'id' in request else None)
+        self.stopped.set()
+        break
+      pending = [future for future in pending if not future.done()]
+      pending.append(self.pool.submit(lambda request=request: send(self.respond(request))))
+    for future in pending:
+      future.result()
+
+  def serve_stdio(self):
+    self.serve(_sys.stdin.buffer, _sys.stdout.buffer)
+
+  def serve_unix(self, path):
+    # Listens on a Unix socket at path, one thread per connection, until a shutdown
+    # request arrives on any of them.
+    server = self
+    class Handler(_socketserver.StreamRequestHandler):
+      def handle(self):
+        server.serve(self.rfile, self.wfile)
+        if server.stopped.is_set():
+          _threading.Thread(target=listener.shutdown).start()
+    if _os.path.exists(path):
+      _os.unlink(path)
+    listener = _socketserver.ThreadingUnixStreamServer(path, Handler)
+    listener.daemon_threads = True
+    try:
+      listener.serve_forever()
+    finally:
+      listener.server_close()
+      _os.unlink(path)
+
+class Client:
+  # A connection to a server listening on a Unix socket. Calls are answered in
+  # order; share one between threads only behind a lock.
+
+  def __init__(self, path):
+    self.socket = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    self.socket.connect(path)
+    self.file = self.socket.makefile('rwb')
+    self.ids = _count(1)
+
+  def call(self, method, **params):
+    id = next(self.ids)
+    self.file.write(_json.dumps({'jsonrpc': '2.0', 'id': id, 'method': method, 'params': params}).encode('utf-8')
+                    + b'\n')
+    self.file.flush()
+    line = self.file.readline()
+    if not line:
+      raise ConnectionError('the server closed the connection')
+    response = _json.loads(line)
+    if 'error' in response:
+      error = response['error']
+      raise ServerError(error['code'], error['message'], error.get('data'))
+    return response['result']
+
+  def transpile(self, source:str=None, *, path:str=None, cythonic:bool=None, indent_amount:int=1):
+    return self.call('transpile', source=source, path=path, cythonic=cythonic, indent_amount=indent_amount)['output']
+
+  def diagnostics(self, source:str=None, *, path:str=None, cythonic:bool=None, indent_amount:int=1):
+    return self.call('diagnostics', source=source, path=path, cythonic=cythonic,
+                     indent_amount=indent_amount)['diagnostics']
+
+  def shutdown(self):
+    self.call('shutdown')
+
+  def close(self):
+    self.file.close()
+    self.socket.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+def main(argv=None):
+  parser = _argparse.ArgumentParser(prog='python -m nestpython.server', description='serve nestPython transpiling')
+  parser.add_argument('--socket', metavar='PATH', help='listen on a Unix socket rather than stdin/stdout')
+  parser.add_argument('--workers', type=int, help='threads answering requests')
+  parser.add_argument('--maxsize', type=int, default=256, help='results kept in the cache')
+  parser.add_argument('--timeout', type=float, help='seconds each transpile may take')
+  parser.add_argument('--max-input', type=int, help='longest source accepted, in characters')
+  parser.add_argument('--max-output', type=int, help='longest output allowed, in characters')
+  parser.add_argument('--version', action='version', version=f'nestpython {__version__}')
+  args = parser.parse_args(argv)
+  limits = _m.CompileLimits(max_input=args.max_input, max_output=args.max_output, timeout=args.timeout)
+  server = Server(args.workers, _m.CompileCache(args.maxsize), limits)
+  if args.socket is None:
+    server.serve_stdio()
+  else:
+    server.serve_unix(args.socket)
+  return 0
+
+if __name__ == '__main__':
+  _sys.exit(main())
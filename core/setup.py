@@ -42,7 +42,8 @@ with open(parse('../README.md'), 'r') as f, open(parse('README.md'), 'w') as fn:
             'License :: OSI Approved :: MIT License',
             'Operating System :: OS Independent',
         ],
-        url=c.__url__
+        url=c.__url__,
+        entry_points={'console_scripts': ['nestpython = nestpython.__main__:main']},
     )
 
 token = open(f'D:/slycefolder/ins/nsp/{ {True: "tt", False: "tr"}[test]}', 'r').read()